@@ -0,0 +1,173 @@
+"""
+Processing pipeline benchmark on synthetic campaigns.
+
+Generates a campaign with benchmarks/synthetic.py in a temporary folder and
+times the pipeline stages on it:
+
+    correlate_data        casi_ + AHB*.XLS correlation of every run (per point dicts)
+    calculate_averages    per point statistics of those dicts
+    correlate_columns     the same correlation as arrays, as procesiraj_vse runs it
+    calculate_statistics  per point and probe statistics of those arrays
+    plotting              izrisi_tocke of one run (optional, --plots)
+    get_data              export rows of every folder
+    write_file_csv        results/all_data.csv
+    write_file_columns    results/all_data/
+    spectral_analysis     spectral.run on the exported columns
+    fit_order_1/2         fit_approximation_planes
+
+For each stage the wall time, the throughput in samples/s and the tracemalloc
+peak are reported; the timings include the tracemalloc overhead. With --record
+the results are appended as one JSON line to benchmarks/results.jsonl (with the
+git revision), so runs can be compared across releases.
+
+    python benchmarks/bench_processing.py --scale 10 --record
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO)
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic  # noqa: E402
+
+RESULTS_FILE = os.path.join(BENCH_DIR, 'results.jsonl')
+
+# Roughly one measurement day of the current campaigns: 4 planes of 10 x 10 points.
+BASE_CAMPAIGN = {'folders': 1, 'runs': 4, 'st_x': 10, 'st_y': 10, 'dwell': 10., 'sample_rate': 1.}
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+@contextlib.contextmanager
+def measure(results, name, samples):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {'seconds': elapsed,
+                         'samples_per_s': samples / elapsed if elapsed > 0 else None,
+                         'peak_memory_bytes': peak}
+
+
+def scaled_campaign(scale, **overrides):
+    """BASE_CAMPAIGN with scale times more runs (spread over folders of at most 8 runs)."""
+    campaign = dict(BASE_CAMPAIGN)
+    runs = max(1, int(round(campaign['runs'] * scale)))
+    campaign['folders'] = max(1, (runs + 7) // 8)
+    campaign['runs'] = int((runs + campaign['folders'] - 1) // campaign['folders'])
+    campaign.update({k: v for k, v in overrides.items() if v is not None})
+    return campaign
+
+
+def run_benchmark(root, campaign, plots=False):
+    summary = synthetic.generate_campaign(root, **campaign)
+    samples = summary['samples']
+
+    import procesiranje
+    import spectral
+    import wind_interpolation
+
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(root)
+    # The pipeline prints every processed file.
+    quiet = contextlib.redirect_stdout(io.StringIO())
+    try:
+        with quiet:
+            runs = sorted(glob.glob(os.path.join('meritve', 'meritve_*', 'casi_*')))
+            with measure(results, 'correlate_data', samples):
+                correlated = [procesiranje.correlate_data(run, os.path.dirname(run)) for run in runs]
+            with measure(results, 'calculate_averages', samples):
+                for points_dict in correlated:
+                    procesiranje.calculate_averages(points_dict)
+            with measure(results, 'correlate_columns', samples):
+                columns = [procesiranje.correlate_columns(run, os.path.dirname(run)) for run in runs]
+            with measure(results, 'calculate_statistics', samples):
+                for stolpci in columns:
+                    procesiranje.calculate_statistics(stolpci)
+            if plots:
+                import matplotlib
+                matplotlib.use('Agg')
+                run = runs[0]
+                with measure(results, 'plotting', samples // len(runs)):
+                    procesiranje.izrisi_tocke(correlated[0], run, os.path.dirname(run))
+
+            with measure(results, 'get_data', samples):
+                rows = []
+                for folder in sorted(glob.glob(os.path.join('meritve', 'meritve_*'))):
+                    rows += procesiranje.get_data(folder)
+            with measure(results, 'write_file_csv', samples):
+                procesiranje.write_file_csv([procesiranje.GLAVA_CSV] + rows)
+            with measure(results, 'write_file_columns', samples):
+                procesiranje.write_file_columns(rows)
+            with measure(results, 'spectral_analysis', samples):
+                spectral.run()
+            for order in (1, 2):
+                with measure(results, 'fit_order_%s' % order, samples):
+                    wind_interpolation.fit_approximation_planes(order)
+    finally:
+        os.chdir(cwd)
+    return summary, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, nargs='+', default=[1.],
+                        help="campaign sizes relative to one current measurement day (e.g. 1 10 100)")
+    parser.add_argument('--st-x', type=int)
+    parser.add_argument('--st-y', type=int)
+    parser.add_argument('--dwell', type=float)
+    parser.add_argument('--sample-rate', type=float)
+    parser.add_argument('--padding', type=float, help="logger seconds before/after every run")
+    parser.add_argument('--plots', action='store_true', help="also time the plotting of one run")
+    parser.add_argument('--keep', action='store_true', help="keep the generated campaign folder")
+    parser.add_argument('--record', action='store_true', help="append the results to %s" % RESULTS_FILE)
+    args = parser.parse_args()
+
+    for scale in args.scale:
+        campaign = scaled_campaign(scale, st_x=args.st_x, st_y=args.st_y, dwell=args.dwell,
+                                   sample_rate=args.sample_rate, padding=args.padding)
+        root = tempfile.mkdtemp(prefix='traverse_bench_')
+        summary, results = run_benchmark(root, campaign, plots=args.plots)
+
+        print("scale %s: %s runs, %s points, %s samples" % (scale, summary['runs'], summary['points'], summary['samples']))
+        print("  %-20s %10s %14s %12s" % ('stage', 'time [s]', 'samples/s', 'peak [MB]'))
+        for name, r in results.items():
+            print("  %-20s %10.3f %14.0f %12.1f" % (name, r['seconds'], r['samples_per_s'] or 0, r['peak_memory_bytes'] / 1e6))
+
+        if args.record:
+            with open(RESULTS_FILE, 'a') as f:
+                f.write(json.dumps({'revision': revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                    'python': sys.version.split()[0], 'scale': scale, 'campaign': campaign,
+                                    'summary': summary, 'results': results}) + '\n')
+        if args.keep:
+            print("  campaign kept in %s" % root)
+        else:
+            import shutil
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Cold start benchmark: time to import each module and to run cheap CLI commands
+in a fresh interpreter.
+
+Run from the repository root (the model commands need results/all_data):
+
+    python benchmarks/bench_startup.py --repeat 5
+
+Every measurement starts a new Python process, so the numbers include the
+interpreter start itself; the "python -c pass" row is that baseline.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+    ('interpreter', ['-c', 'pass']),
+    ('import data_store', ['-c', 'import data_store']),
+    ('import wind_interpolation', ['-c', 'import wind_interpolation']),
+    ('import wind_field', ['-c', 'import wind_field']),
+    ('import procesiranje', ['-c', 'import procesiranje']),
+    ('import commands', ['-c', 'import commands']),
+    ('import cli', ['-c', 'import cli']),
+    ('traverse --help', [os.path.join(REPO, 'cli.py'), '--help']),
+]
+
+MODEL_CASES = [
+    ('traverse query percentage', [os.path.join(REPO, 'cli.py'), 'query', 'percentage', '10', '25']),
+]
+
+
+def time_command(argv, repeat):
+    env = dict(os.environ, PYTHONPATH=REPO + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + argv, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--model', action='store_true', help="also time model queries (needs results/all_data)")
+    args = parser.parse_args()
+
+    cases = CASES + (MODEL_CASES if args.model else [])
+    print("%-30s %10s %10s" % ('case', 'min [ms]', 'median [ms]'))
+    for name, argv in cases:
+        times = time_command(argv, args.repeat)
+        print("%-30s %10.1f %10.1f" % (name, 1000 * min(times), 1000 * statistics.median(times)))
+
+
+if __name__ == "__main__":
+    main()
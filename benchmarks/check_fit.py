@@ -0,0 +1,67 @@
+"""
+Check of wind_interpolation.fit_location_models against scipy.linalg.lstsq.
+
+Fits shuffled samples with an uneven number of samples per location (as
+procesiraj_vse exports them: grouped by run, with logger jitter in the point
+lengths) and compares the fitted velocities and residuals of every location
+with a per-location lstsq. Exits with status 1 on a mismatch.
+
+    python benchmarks/check_fit.py
+"""
+
+import os
+import sys
+
+import numpy as np
+import scipy.linalg
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wind_interpolation  # noqa: E402
+
+TOLERANCE = 1e-6
+
+
+def check(order, n_locations=40, seed=0, batch_values=None):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(20, 300, n_locations)
+    index = rng.permutation(np.repeat(np.arange(n_locations), counts))
+    percentage = rng.choice([20., 40., 60., 80.], len(index))
+    temperature = 25 + 0.5 * rng.standard_normal(len(index))
+    velocity = 0.1 * percentage + 0.02 * (temperature - 25)**2 + index * 0.01 + 0.3 * rng.standard_normal(len(index))
+
+    previous = wind_interpolation.FIT_BATCH_VALUES
+    if batch_values is not None:
+        wind_interpolation.FIT_BATCH_VALUES = batch_values
+    try:
+        C, residuals, cond = wind_interpolation.fit_location_models(index, percentage, temperature, velocity,
+                                                                    order=order, n_locations=n_locations)
+    finally:
+        wind_interpolation.FIT_BATCH_VALUES = previous
+
+    velocity_error = residual_error = 0.
+    for location in range(n_locations):
+        mask = index == location
+        A = wind_interpolation.design_matrix(percentage[mask], temperature[mask], order)
+        c = scipy.linalg.lstsq(A, velocity[mask])[0]
+        velocity_error = max(velocity_error, np.abs(A @ c - A @ C[location]).max())
+        reference = np.sum((A @ c - velocity[mask])**2)
+        residual_error = max(residual_error, abs(residuals[location] - reference) / reference)
+    return velocity_error, residual_error
+
+
+def main():
+    failed = False
+    for order in (1, 2, 3):
+        # The small batch also covers locations split over several SVD blocks.
+        for batch_values in (None, 5000):
+            velocity_error, residual_error = check(order, batch_values=batch_values)
+            ok = velocity_error < TOLERANCE and residual_error < TOLERANCE
+            failed |= not ok
+            print("order %s, batch %-7s velocity %.2e  residuals %.2e  %s"
+                  % (order, batch_values or 'default', velocity_error, residual_error, 'ok' if ok else 'MISMATCH'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
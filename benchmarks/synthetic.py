@@ -0,0 +1,141 @@
+"""
+Synthetic measurement campaign generator.
+
+Writes meritve/meritve_* folders that look like the ones produced on the rig:
+a casi_ log per run written in the format of Traverse.traverse_plane (with the
+hand added _<percent>p suffix) and tab separated AHB*.XLS anemometer logs with
+quoted decimal-comma values and both date formats the logger uses.
+
+    python benchmarks/synthetic.py /tmp/campaign --folders 2 --runs 4 --st-x 10 --st-y 10 --dwell 10
+
+The velocity is a smooth function of tunnel percentage, temperature and position
+plus gaussian noise, so the wind model fits on the result are meaningful too.
+"""
+
+import argparse
+import math
+import os
+import random
+from datetime import datetime, timedelta
+
+CASI_TIME_FORMAT = '%a, %d %b %Y %H:%M:%S'
+XLS_DATE_FORMATS = ('%Y/%m/%d', '%m/%d/%Y')
+
+
+def _decimal_comma(value, digits):
+    return ('"%.*f"' % (digits, value)).replace('.', ',')
+
+
+def _velocity(percentage, temperature, y, z, rng, noise):
+    profile = 1. - 0.15 * ((y - 500.) / 500.) ** 2 - 0.1 * ((z - 500.) / 500.) ** 2
+    return max(0., (0.25 * percentage + 0.05 * temperature) * profile + rng.gauss(0., noise))
+
+
+def generate_campaign(root, folders=1, runs=2, st_x=10, st_y=10, dwell=10., sample_rate=1.,
+                      percentages=(20, 40, 60, 80), transit=3., padding=0., xls_files=1,
+                      noise=0.3, start=datetime(2019, 1, 25, 9, 0, 0), seed=0):
+    """
+    Write a synthetic campaign below root/meritve.
+
+    Args:
+        root (str): Output folder, meritve/ and results/ are created inside
+        folders (int): Number of meritve_* folders (one per measurement day)
+        runs (int): casi_ runs per folder, cycling through percentages
+        st_x, st_y (int): Traverse grid size of every run
+        dwell (float): Measuring time at each point [s]
+        sample_rate (float): Anemometer samples per second
+        percentages (tuple): Wind tunnel percentages of the runs
+        transit (float): Time between mov_start and point_start [s]
+        padding (float): Logger time recorded before and after every run [s]
+        xls_files (int): Number of AHB*.XLS files the day is split into
+        noise (float): Standard deviation of the velocity noise [m/s]
+        start (datetime): Start of the first day
+        seed (int): Random seed
+
+    Returns:
+        dict: Summary with the number of points, runs and samples written
+    """
+    rng = random.Random(seed)
+    ys = [i * 1000. / max(st_x - 1, 1) for i in range(st_x)]
+    zs = [j * 1000. / max(st_y - 1, 1) for j in range(st_y)]
+    sample_step = timedelta(seconds=1. / sample_rate)
+
+    summary = {'folders': folders, 'runs': 0, 'points': 0, 'samples': 0}
+    os.makedirs(os.path.join(root, 'results', 'slikice_skupaj'), exist_ok=True)
+    os.makedirs(os.path.join(root, 'results', 'slikice_absolute_skupaj'), exist_ok=True)
+
+    for f in range(folders):
+        day_start = start + timedelta(days=f)
+        folder = os.path.join(root, 'meritve', 'meritve_' + day_start.strftime('%d_%m_%Y'))
+        for sub in ('slikice', 'slikice_absolute'):
+            os.makedirs(os.path.join(folder, sub), exist_ok=True)
+
+        samples = []
+        t = day_start
+        t_logger = day_start
+
+        def log_until(end, percentage, temperature, y, z):
+            # The logger runs continuously, also while the traverse is moving.
+            nonlocal t_logger
+            while t_logger < end:
+                samples.append((t_logger, percentage, temperature, y, z))
+                t_logger += sample_step
+
+        for r in range(runs):
+            percentage = percentages[(f * runs + r) % len(percentages)]
+            temperature = 15. + 5. * math.sin(r + f) + rng.gauss(0., 0.5)
+            t += timedelta(seconds=padding)
+            log_until(t, percentage, temperature, ys[0], zs[0])
+            name = 'casi_%s_%sp' % (t.strftime('%d_%b_%Y_%H_%M_%S'), percentage)
+            with open(os.path.join(folder, name), 'w') as casi:
+                rev = False
+                for y in ys:
+                    for z in (zs[::-1] if rev else zs):
+                        casi.write('mov_start,%s\n' % t.strftime(CASI_TIME_FORMAT))
+                        t += timedelta(seconds=transit)
+                        casi.write('point_start,%s,%s,%s,%s\n' % (t.strftime(CASI_TIME_FORMAT), 0.0, y, z))
+                        t += timedelta(seconds=dwell)
+                        log_until(t, percentage, temperature, y, z)
+                        summary['points'] += 1
+                    rev = not rev
+                casi.write('point_end,%s,%s,%s,%s\n' % (t.strftime(CASI_TIME_FORMAT), 0.0, y, z))
+            t += timedelta(seconds=padding)
+            log_until(t, percentage, temperature, y, z)
+            summary['runs'] += 1
+
+        per_file = int(math.ceil(len(samples) / float(xls_files)))
+        for i in range(xls_files):
+            path = os.path.join(folder, 'AHB01%03d.XLS' % i)
+            with open(path, 'w') as xls:
+                xls.write('Place\tDate\tTime\tValue\tUnit\tValue\tUnit\n')
+                for n, (ts, percentage, temperature, y, z) in enumerate(samples[i * per_file:(i + 1) * per_file]):
+                    xls.write('1\t%s\t%s\t%s\tm/S     \t%s\tAMTemp C\n' % (
+                        ts.strftime(XLS_DATE_FORMATS[n % 2]), ts.strftime('%H:%M:%S'),
+                        _decimal_comma(_velocity(percentage, temperature, y, z, rng, noise), 2),
+                        _decimal_comma(temperature + rng.gauss(0., 0.2), 1)))
+        summary['samples'] += len(samples)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root')
+    parser.add_argument('--folders', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--st-x', type=int, default=10)
+    parser.add_argument('--st-y', type=int, default=10)
+    parser.add_argument('--dwell', type=float, default=10.)
+    parser.add_argument('--sample-rate', type=float, default=1.)
+    parser.add_argument('--percentages', type=int, nargs='+', default=[20, 40, 60, 80])
+    parser.add_argument('--padding', type=float, default=0., help="logger seconds before/after every run")
+    parser.add_argument('--xls-files', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    summary = generate_campaign(args.root, folders=args.folders, runs=args.runs, st_x=args.st_x, st_y=args.st_y,
+                                dwell=args.dwell, sample_rate=args.sample_rate, percentages=args.percentages,
+                                padding=args.padding, xls_files=args.xls_files, seed=args.seed)
+    print(summary)
+
+
+if __name__ == "__main__":
+    main()
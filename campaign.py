@@ -0,0 +1,372 @@
+"""
+Campaign scheduler for measurement series over several planes and tunnel settings.
+
+A campaign is a JSON file with the planes (the arguments of
+Traverse.traverse_plane) and the tunnel percentages to measure each of them at:
+
+    {
+        "planes": [
+            {"name": "x0", "x1": 0, "y1": 0, "x2": 1000, "y2": 1000, "st_x": 10, "st_y": 10, "plane": "zy"},
+            {"name": "x500", "x1": 0, "y1": 0, "x2": 1000, "y2": 1000, "st_x": 10, "st_y": 10, "plane": "zy",
+             "offset": [500, 0, 0]}
+        ],
+        "percentages": [20, 40, 60],
+        "delay": 10
+    }
+
+offset is where the operator has placed the traverse for that plane, relative
+to the reference position: the traverse can not reach it by itself, it only
+writes the offset into the logged coordinates. Whenever consecutive runs have
+different offsets, the operator is asked to move the traverse.
+
+Every (plane, percentage) pair is one run. plan() orders the runs to minimise
+the predicted campaign time, which is made of:
+
+    transit     traverse moves between points and between runs (all axes move at once)
+    reposition  the operator moving the traverse to another offset
+    settle      waiting for the flow after every tunnel speed change
+    dwell       delay at every point
+
+Two orders are compared: all planes at one percentage before changing the
+tunnel (percentage major), and all percentages on one plane before moving on
+(plane major). Within them, planes are ordered and traversed forwards or
+backwards so every run starts close to where the previous one ended, and
+percentages are swept monotonically (alternating direction in plane major).
+
+run_campaign() executes a plan: it asks the operator to move the traverse when
+the offset changes and to set the tunnel when the percentage changes, waits for
+the flow to settle, runs traverse_plane with the _<percent>p suffix procesiranje
+expects and logs the planned and actual times of every run to
+campaign_<date>_<time>.jsonl in the measurement folder.
+
+    traverse campaign plan campaign.json
+    traverse campaign run campaign.json --port COM9
+"""
+
+import itertools
+import json
+import os
+import time
+
+# execute_absolute_movement uses 10000 steps/s on every axis, 320 steps are 1 mm.
+DEFAULT_SPEED = 10000 / 320.
+
+DEFAULTS = {
+    'delay': 10.,               # dwell at every point [s]
+    'settle_time': 60.,         # flow settling after any tunnel change [s]
+    'settle_per_percent': 1.,   # additional settling per percent of change [s]
+    'speed': DEFAULT_SPEED,     # traverse speed of every axis [mm/s]
+    'move_overhead': 0.5,       # command and acceleration overhead of every move [s]
+    'reposition_time': 600.,    # operator moving the traverse to another offset [s]
+    'start': [0., 0., 0.],      # traverse position before the first run [mm]
+    'start_offset': [0., 0., 0.],  # offset the traverse is placed at before the first run [mm]
+    'start_percentage': 0.,     # tunnel percentage before the first run
+}
+PLANE_DEFAULTS = {'plane': 'zy', 'offset': [0., 0., 0.]}
+
+# Plane orders up to this many planes are searched exhaustively, longer ones greedily.
+EXACT_PLANES = 8
+
+
+def generate_path(x1, y1, x2, y2, st_x, st_y, plane):
+    """Points of a plane in traverse order, the same as Traverse.generate_path()."""
+    import numpy
+
+    str_to_cartesian = {'x': 0, 'y': 1, 'z': 2}
+    path = []
+    rev = False
+    for a in numpy.linspace(x1, x2, st_x):
+        for b in (numpy.linspace(y1, y2, st_y)[::-1] if rev else numpy.linspace(y1, y2, st_y)):
+            point = [0., 0., 0.]
+            point[str_to_cartesian[plane[0]]] = float(a)
+            point[str_to_cartesian[plane[1]]] = float(b)
+            path.append(tuple(point))
+        rev = not rev
+    return path
+
+
+class Campaign:
+    """
+    Campaign definition with the timing model used to predict run durations.
+
+    Args:
+        planes (list): Dicts with the traverse_plane arguments x1, y1, x2, y2,
+            st_x, st_y and optionally name, plane, offset (where the operator places
+            the traverse for the plane), delay and percentages
+        percentages (list): Tunnel percentages of every plane without its own list
+        **settings: Overrides of DEFAULTS
+    """
+
+    def __init__(self, planes, percentages=(), **settings):
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown campaign setting(s): %s" % ', '.join(sorted(unknown)))
+        self.settings = dict(DEFAULTS, **settings)
+        self.planes = []
+        for i, p in enumerate(planes):
+            plane = dict(PLANE_DEFAULTS, name='plane%s' % i, delay=self.settings['delay'],
+                         percentages=list(percentages))
+            plane.update(p)
+            if not plane['percentages']:
+                raise ValueError("Plane %s has no tunnel percentages" % plane['name'])
+            plane['path'] = generate_path(plane['x1'], plane['y1'], plane['x2'], plane['y2'],
+                                          plane['st_x'], plane['st_y'], plane['plane'])
+            self.planes.append(plane)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            definition = json.load(f)
+        return cls(**definition)
+
+    def transit_time(self, a, b):
+        """Seconds to move the traverse from a to b."""
+        distance = max(abs(a[i] - b[i]) for i in range(3))
+        if distance == 0:
+            return 0.
+        return distance / self.settings['speed'] + self.settings['move_overhead']
+
+    def reposition_time(self, a, b):
+        """Seconds for the operator to move the traverse from offset a to offset b."""
+        if [float(v) for v in a] == [float(v) for v in b]:
+            return 0.
+        return self.settings['reposition_time']
+
+    def entry_time(self, position, offset, plane, reverse):
+        """Seconds from position at offset to the first point of a run of plane."""
+        return self.reposition_time(offset, plane['offset']) + \
+            self.transit_time(position, self.ends(plane, reverse)[0])
+
+    def settle_time(self, previous, percentage):
+        if previous == percentage:
+            return 0.
+        return self.settings['settle_time'] + self.settings['settle_per_percent'] * abs(percentage - previous)
+
+    def measuring_time(self, plane):
+        """Seconds of one run of a plane, from its first point to its point_end (direction independent)."""
+        path = plane['path']
+        moves = sum(self.transit_time(a, b) for a, b in zip(path, path[1:]))
+        return moves + len(path) * plane['delay']
+
+    def ends(self, plane, reverse):
+        path = plane['path']
+        return (path[-1], path[0]) if reverse else (path[0], path[-1])
+
+
+def _order_planes(campaign, planes, position, offset):
+    """
+    Order and directions of planes that minimise the transit and repositioning between them,
+    starting at position with the traverse at offset.
+
+    Returns:
+        list: (plane index, reverse) pairs
+    """
+    planes = list(planes)
+    states = [(k, reverse) for k in range(len(planes)) for reverse in (False, True)]
+    ends = {(k, reverse): campaign.ends(campaign.planes[planes[k]], reverse) for k, reverse in states}
+
+    if len(planes) > EXACT_PLANES:
+        order = []
+        remaining = set(range(len(planes)))
+        while remaining:
+            k, reverse = min(((k, r) for k in remaining for r in (False, True)),
+                             key=lambda s: campaign.entry_time(position, offset, campaign.planes[planes[s[0]]], s[1]))
+            order.append((planes[k], reverse))
+            remaining.discard(k)
+            position = ends[(k, reverse)][1]
+            offset = campaign.planes[planes[k]]['offset']
+        return order
+
+    # Shortest open path over the planes, every plane entered from either end (Held-Karp).
+    transit = {(a, b): campaign.entry_time(ends[a][1], campaign.planes[planes[a[0]]]['offset'],
+                                           campaign.planes[planes[b[0]]], b[1])
+               for a in states for b in states if a[0] != b[0]}
+    best = {(1 << k, (k, reverse)): (campaign.entry_time(position, offset, campaign.planes[planes[k]], reverse), None)
+            for k, reverse in states}
+    for size in range(2, len(planes) + 1):
+        for subset in itertools.combinations(range(len(planes)), size):
+            mask = sum(1 << k for k in subset)
+            for k in subset:
+                rest = mask & ~(1 << k)
+                previous_states = [(j, r) for j in subset if j != k for r in (False, True)]
+                for reverse in (False, True):
+                    state = (k, reverse)
+                    best[(mask, state)] = min(((best[(rest, p)][0] + transit[(p, state)], p) for p in previous_states),
+                                              key=lambda c: c[0])
+    mask = (1 << len(planes)) - 1
+    state = min(states, key=lambda s: best[(mask, s)][0])
+    order = []
+    while state is not None:
+        order.append((planes[state[0]], state[1]))
+        previous = best[(mask, state)][1]
+        mask &= ~(1 << state[0])
+        state = previous
+    return order[::-1]
+
+
+def predict(campaign, runs):
+    """
+    Predicted timeline of runs in the given order.
+
+    Args:
+        runs (list): (plane index, percentage, reverse) tuples
+
+    Returns:
+        list: One dict per run with its timing, times in seconds from the campaign start
+    """
+    position = campaign.settings['start']
+    offset = campaign.settings['start_offset']
+    percentage = campaign.settings['start_percentage']
+    now = 0.
+    schedule = []
+    for i, run_percentage, reverse in runs:
+        plane = campaign.planes[i]
+        entry, exit_point = campaign.ends(plane, reverse)
+        settle = campaign.settle_time(percentage, run_percentage)
+        reposition = campaign.reposition_time(offset, plane['offset'])
+        transit = campaign.transit_time(position, entry)
+        measuring = campaign.measuring_time(plane)
+        # The traverse is repositioned and moves to the first point while the flow settles.
+        start = now + max(settle, reposition + transit)
+        schedule.append({'plane': plane['name'], 'plane_index': i, 'percentage': run_percentage,
+                         'reverse': reverse, 'offset': list(plane['offset']), 'settle_s': settle,
+                         'reposition_s': reposition, 'transit_s': transit,
+                         'measuring_s': measuring, 'start_s': start, 'end_s': start + measuring})
+        now = start + measuring
+        position = exit_point
+        offset = plane['offset']
+        percentage = run_percentage
+    return schedule
+
+
+def _percentage_major(campaign):
+    percentages = sorted({p for plane in campaign.planes for p in plane['percentages']})
+    if abs(percentages[-1] - campaign.settings['start_percentage']) < abs(percentages[0] - campaign.settings['start_percentage']):
+        percentages = percentages[::-1]
+    runs = []
+    position = campaign.settings['start']
+    offset = campaign.settings['start_offset']
+    for percentage in percentages:
+        planes = [i for i, plane in enumerate(campaign.planes) if percentage in plane['percentages']]
+        for i, reverse in _order_planes(campaign, planes, position, offset):
+            runs.append((i, percentage, reverse))
+            position = campaign.ends(campaign.planes[i], reverse)[1]
+            offset = campaign.planes[i]['offset']
+    return runs
+
+
+def _plane_major(campaign):
+    runs = []
+    position = campaign.settings['start']
+    offset = campaign.settings['start_offset']
+    percentage = campaign.settings['start_percentage']
+    remaining = set(range(len(campaign.planes)))
+    while remaining:
+        # Nearest plane next; it is measured back and forth, so it is left at its entry
+        # point after an even number of runs.
+        i, reverse = min(((i, r) for i in remaining for r in (False, True)),
+                         key=lambda s: campaign.entry_time(position, offset, campaign.planes[s[0]], s[1]))
+        remaining.discard(i)
+        percentages = sorted(campaign.planes[i]['percentages'])
+        if abs(percentages[0] - percentage) > abs(percentages[-1] - percentage):
+            percentages = percentages[::-1]
+        for k, p in enumerate(percentages):
+            runs.append((i, p, reverse != bool(k % 2)))
+        position = campaign.ends(campaign.planes[i], runs[-1][2])[1]
+        offset = campaign.planes[i]['offset']
+        percentage = percentages[-1]
+    return runs
+
+
+def plan(campaign):
+    """
+    Cheapest of the candidate run orders and its predicted schedule.
+
+    Returns:
+        tuple: (strategy name, schedule as returned by predict())
+    """
+    candidates = []
+    for name, order in (('percentage major', _percentage_major), ('plane major', _plane_major)):
+        schedule = predict(campaign, order(campaign))
+        candidates.append((schedule[-1]['end_s'] if schedule else 0., name, schedule))
+    total, name, schedule = min(candidates, key=lambda c: c[0])
+    return name, schedule
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def print_plan(campaign, strategy, schedule):
+    print("Campaign of %s runs, %s order" % (len(schedule), strategy))
+    print("  %-4s %-12s %8s %4s %10s %10s %10s %10s %10s" % ('#', 'plane', 'percent', 'rev', 'settle', 'reposition',
+                                                           'transit', 'measuring', 'start'))
+    for n, run in enumerate(schedule):
+        print("  %-4s %-12s %8g %4s %10s %10s %10s %10s %10s" % (
+            n + 1, run['plane'], run['percentage'], 'yes' if run['reverse'] else '',
+            format_duration(run['settle_s']), format_duration(run['reposition_s']),
+            format_duration(run['transit_s']), format_duration(run['measuring_s']),
+            format_duration(run['start_s'])))
+    total = schedule[-1]['end_s'] if schedule else 0.
+    measuring = sum(run['measuring_s'] for run in schedule)
+    print("Predicted duration %s, of that %s between runs (settling, repositioning and transit)" % (
+        format_duration(total), format_duration(total - measuring)))
+
+
+def run_campaign(traverse, campaign, schedule, confirm=input, preview=False):
+    """
+    Measure the runs of a schedule with a Traverse.
+
+    Args:
+        traverse (Traverse): Initialized traverse
+        schedule (list): From plan() or predict()
+        confirm (callable): Called with a message when the operator has to move the traverse
+            to another offset or change the tunnel
+        preview (bool): Live preview of every plane (see traverse_plane)
+
+    Returns:
+        list: Paths of the written casi_ files
+    """
+    started = time.time()
+    log_path = None
+    casi_paths = []
+    offset = campaign.settings['start_offset']
+    percentage = campaign.settings['start_percentage']
+    for n, run in enumerate(schedule):
+        plane = campaign.planes[run['plane_index']]
+        idle_start = time.time()
+        if campaign.reposition_time(offset, plane['offset']):
+            # traverse_plane only writes the offset into the coordinates, the traverse has to be moved by hand.
+            confirm("Move the traverse to offset %s mm for plane %s and press Enter " % (
+                ', '.join('%g' % v for v in plane['offset']), plane['name']))
+            offset = plane['offset']
+        if run['percentage'] != percentage:
+            confirm("Set the tunnel to %s %% and press Enter " % run['percentage'])
+            settle_start = time.time()
+            first_point = campaign.ends(plane, run['reverse'])[0]
+            traverse.execute_absolute_movement(*first_point)
+            time.sleep(max(0., run['settle_s'] - (time.time() - settle_start)))
+            percentage = run['percentage']
+        run_start = time.time()
+        offset = plane['offset']
+        casi_path = traverse.traverse_plane(plane['x1'], plane['y1'], plane['x2'], plane['y2'],
+                                            plane['st_x'], plane['st_y'], delay=plane['delay'],
+                                            plane=plane['plane'], offset_write_x=offset[0],
+                                            offset_write_y=offset[1], offset_write_z=offset[2],
+                                            preview=preview, name_suffix='%gp' % run['percentage'],
+                                            reverse=run['reverse'])
+        run_end = time.time()
+        casi_paths.append(casi_path)
+
+        if log_path is None:
+            log_path = os.path.join(os.path.dirname(casi_path), 'campaign_%s.jsonl' % time.strftime(
+                '%d_%b_%Y_%H_%M_%S', time.localtime(started)))
+        entry = dict(run, run=n + 1, casi=os.path.basename(casi_path),
+                     actual_start_s=run_start - started, actual_end_s=run_end - started,
+                     actual_idle_s=run_start - idle_start, actual_measuring_s=run_end - run_start)
+        with open(log_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        print("Run %s/%s done, %s behind the plan" % (n + 1, len(schedule),
+                                                     format_duration(max(0., entry['actual_end_s'] - run['end_s']))))
+    return casi_paths
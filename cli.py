@@ -0,0 +1,223 @@
+"""
+Command line interface for the whole measurement pipeline.
+
+    traverse run      Traverse a measurement plane with the ISEL controller
+    traverse campaign Plan or run a series of planes at several tunnel settings
+    traverse process  Draw the plots and export all measurements
+    traverse export   Export all measurements without drawing
+    traverse spectra  Spectral turbulence analysis of the exported measurements
+    traverse model    Fit (or load) the wind model and print a summary
+    traverse query    Predict velocities, tunnel percentages or field values
+    traverse serve    Start the wind model query server
+    traverse watch    Process new samples while the measurements are running
+
+Every subcommand imports only the modules it needs, so e.g. a model query never
+loads pyserial or matplotlib.
+"""
+
+import argparse
+import sys
+
+
+def cmd_run(args):
+    from commands import Traverse
+
+    traverse = Traverse(port=args.port)
+    traverse.initialize(num_axes=3)
+    if args.reference:
+        traverse.reference_run()
+    traverse.traverse_plane(args.x1, args.y1, args.x2, args.y2, args.st_x, args.st_y,
+                            delay=args.delay, plane=args.plane,
+                            offset_write_x=args.offset[0], offset_write_y=args.offset[1],
+                            offset_write_z=args.offset[2],
+                            preview=args.preview, preview_window=args.preview_window,
+                            preview_logs=args.preview_logs, preview_probe=args.preview_probe)
+
+
+def cmd_campaign(args):
+    import campaign
+
+    definition = campaign.Campaign.load(args.file)
+    strategy, schedule = campaign.plan(definition)
+    campaign.print_plan(definition, strategy, schedule)
+    if args.action == 'run':
+        from commands import Traverse
+
+        traverse = Traverse(port=args.port)
+        traverse.initialize(num_axes=3)
+        if args.reference:
+            traverse.reference_run()
+        campaign.run_campaign(traverse, definition, schedule, preview=args.preview)
+
+
+def cmd_process(args):
+    import procesiranje
+
+    procesiranje.procesiraj_vse(args.meritve, generate_data=True, make_pictures=True,
+                                write_csv=not args.no_csv, spectral_analysis=not args.no_spectral)
+
+
+def cmd_export(args):
+    import procesiranje
+
+    procesiranje.procesiraj_vse(args.meritve, generate_data=True, make_pictures=False,
+                                write_csv=not args.no_csv, spectral_analysis=not args.no_spectral)
+
+
+def cmd_spectra(args):
+    import numpy as np
+    import spectral
+
+    result = spectral.run(nperseg=args.nperseg, max_lag=args.max_lag, fs=args.fs)
+    print("%s points, %s stationary, median integral time scale %.3g s" % (
+        len(result['samples']), int(np.sum(result['stationary'])), np.nanmedian(result['integral_time_s'])))
+    print("Written to %s and %s" % (spectral.DEFAULT_CSV_PATH, spectral.DEFAULT_NPZ_PATH))
+
+
+def cmd_model(args):
+    import numpy as np
+    import wind_interpolation
+
+    model = wind_interpolation.get_model(args.order, rebuild=args.rebuild)
+    print("Wind model %s, order %s, %s locations" % (model.source_hash[:8], model.order, len(model.locations)))
+    print("Residual sum of squares: min %.4g, median %.4g, max %.4g" % (
+        np.min(model.residuals), np.median(model.residuals), np.max(model.residuals)))
+    print("Condition number: max %.4g" % np.max(model.cond))
+
+
+def cmd_query(args):
+    if args.what == 'wind':
+        import wind_interpolation
+
+        model = wind_interpolation.get_model(args.order)
+        velocity, plane_mean = model.evaluate(args.percentage, args.temperature)
+        for (x, y, z), v in zip(model.locations, velocity[0]):
+            print("%g,%g,%g,%.4f" % (x, y, z, v))
+        print("Average: %.4f m/s" % plane_mean[0])
+    elif args.what == 'percentage':
+        import wind_interpolation
+
+        wind_interpolation.get_percentage(args.temperature, args.desired_speed,
+                                          order=args.order, location=args.location)
+    elif args.what == 'field':
+        import wind_field
+
+        field = wind_field.get_wind_field(args.order)
+        print("%.4f" % field.query(args.y, args.z, args.percentage, args.temperature))
+
+
+def cmd_watch(args):
+    from watch import Watcher
+
+    Watcher(args.meritve, make_pictures=not args.no_pictures, write_csv=not args.no_csv).run(args.interval)
+
+
+def cmd_serve(args):
+    import logging
+    import wind_server
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    wind_server.serve(args.host, args.port, args.order, args.preload_field)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='traverse', description="Wind tunnel traverse measurement pipeline.")
+    parser.add_argument('--profile', action='store_true', help="profile the run and write a JSON trace")
+    parser.add_argument('--profile-mode', metavar='MODE', default='timers,memory',
+                        help="comma separated: timers, memory, cprofile, pyinstrument (default: timers,memory)")
+    parser.add_argument('--profile-out', metavar='PATH', help="JSON trace path (default: results/profile_<date>_<time>.json)")
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    run = subparsers.add_parser('run', help="traverse a measurement plane")
+    run.add_argument('x1', type=float)
+    run.add_argument('y1', type=float)
+    run.add_argument('x2', type=float)
+    run.add_argument('y2', type=float)
+    run.add_argument('st_x', type=int, help="number of steps in the first plane direction")
+    run.add_argument('st_y', type=int, help="number of steps in the second plane direction")
+    run.add_argument('--port', default='COM9', help="serial port of the controller (default: COM9)")
+    run.add_argument('--delay', type=float, default=10, help="measuring time at each point in seconds")
+    run.add_argument('--plane', default='zy', choices=['xy', 'yx', 'xz', 'zx', 'yz', 'zy'])
+    run.add_argument('--offset', type=float, nargs=3, default=(0, 0, 0), metavar=('X', 'Y', 'Z'),
+                     help="offset added to the logged coordinates")
+    run.add_argument('--reference', action='store_true', help="do a reference run first")
+    run.add_argument('--preview', action='store_true', help="draw a live preview to slikice/preview_<casi>.png")
+    run.add_argument('--preview-window', action='store_true', help="also show the live preview in a window")
+    run.add_argument('--preview-logs', metavar='DIR', help="folder with the AHB*.XLS logs for the preview")
+    run.add_argument('--preview-probe', metavar='PROBE',
+                     help="preview only this probe (default: every probe at its sonde.json offset)")
+    run.set_defaults(func=cmd_run)
+
+    campaign = subparsers.add_parser('campaign', help="plan or run a series of planes at several tunnel settings")
+    campaign.add_argument('action', choices=['plan', 'run'], help="print the predicted schedule, or also run it")
+    campaign.add_argument('file', help="campaign definition (JSON, see campaign.py)")
+    campaign.add_argument('--port', default='COM9', help="serial port of the controller (default: COM9)")
+    campaign.add_argument('--reference', action='store_true', help="do a reference run first")
+    campaign.add_argument('--preview', action='store_true', help="live preview of every plane")
+    campaign.set_defaults(func=cmd_campaign)
+
+    for name, func, help_text in (('process', cmd_process, "draw plots and export all measurements"),
+                                  ('export', cmd_export, "export all measurements without drawing")):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('--meritve', default='meritve', help="folder with the meritve_* folders")
+        sub.add_argument('--no-csv', action='store_true', help="skip results/all_data.csv")
+        sub.add_argument('--no-spectral', action='store_true', help="skip the spectral analysis")
+        sub.set_defaults(func=func)
+
+    spectra = subparsers.add_parser('spectra', help="spectral analysis of the exported measurements")
+    spectra.add_argument('--nperseg', type=int, default=64, help="Welch segment length in samples")
+    spectra.add_argument('--max-lag', type=int, default=256, help="longest autocorrelation lag in samples")
+    spectra.add_argument('--fs', type=float, help="anemometer sample rate in Hz (default: estimated per point)")
+    spectra.set_defaults(func=cmd_spectra)
+
+    model = subparsers.add_parser('model', help="fit or load the wind model")
+    model.add_argument('--order', type=int, default=1)
+    model.add_argument('--rebuild', action='store_true', help="refit and overwrite the stored model")
+    model.set_defaults(func=cmd_model)
+
+    query = subparsers.add_parser('query', help="query the wind model")
+    query.add_argument('--order', type=int, default=1)
+    what = query.add_subparsers(dest='what', metavar='what')
+    what.required = True
+    wind = what.add_parser('wind', help="velocity at every location")
+    wind.add_argument('percentage', type=float)
+    wind.add_argument('temperature', type=float)
+    percentage = what.add_parser('percentage', help="tunnel percentage for a target speed")
+    percentage.add_argument('desired_speed', type=float)
+    percentage.add_argument('temperature', type=float)
+    percentage.add_argument('--location', type=float, nargs=3, metavar=('X', 'Y', 'Z'),
+                            help="target one traverse location instead of the plane average")
+    field = what.add_parser('field', help="velocity at an arbitrary (y, z) position")
+    for name in ('y', 'z', 'percentage', 'temperature'):
+        field.add_argument(name, type=float)
+    query.set_defaults(func=cmd_query)
+
+    serve = subparsers.add_parser('serve', help="start the wind model query server")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--order', type=int, default=1)
+    serve.add_argument('--preload-field', action='store_true')
+    serve.set_defaults(func=cmd_serve)
+
+    watch = subparsers.add_parser('watch', help="process new samples while the measurements are running")
+    watch.add_argument('--meritve', default='meritve', help="folder with the meritve_* folders")
+    watch.add_argument('--interval', type=float, default=2., help="seconds between polls")
+    watch.add_argument('--no-pictures', action='store_true', help="do not redraw the figures")
+    watch.add_argument('--no-csv', action='store_true', help="skip results/all_data.csv")
+    watch.set_defaults(func=cmd_watch)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.profile:
+        import profiling
+
+        profiling.enable(profiling.parse_modes(args.profile_mode), args.profile_out)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
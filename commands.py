@@ -77,8 +77,6 @@ import serial
 import time
 import os
 import logging
-import tqdm
-import numpy
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -286,6 +284,8 @@ class Traverse:
         return self.transmit_command(s)
 
     def generate_path(self,x1,y1,x2,y2,st_x,st_y,plane):
+        import numpy
+
         x_line = numpy.linspace(x1,x2,st_x)
         y_line = numpy.linspace(y1,y2,st_y)
         x_y = []
@@ -314,7 +314,9 @@ class Traverse:
 
 
 
-    def traverse_plane(self,x1,y1,x2,y2,st_x,st_y,delay=10,plane="zy",offset_write_x=0,offset_write_y=0,offset_write_z=0):
+    def traverse_plane(self,x1,y1,x2,y2,st_x,st_y,delay=10,plane="zy",offset_write_x=0,offset_write_y=0,offset_write_z=0,
+                       preview=False,preview_window=False,preview_logs=None,name_suffix=None,reverse=False,
+                       preview_probe=None):
         """Move the traverse system along a plane using a grid pattern.
 
         This method performs automated measurement traversal, creating timestamped
@@ -327,12 +329,25 @@ class Traverse:
             delay (float): Delay time at each measurement point (seconds)
             plane (str): Plane to traverse ('xy', 'yx', 'xz', 'zx', 'yz', 'zy')
             offset_write_x, offset_write_y, offset_write_z (float): Coordinate offsets for data logging
+            preview (bool): Draw a live preview of the measured points (see live_preview.py)
+            preview_window (bool): Also show the preview in a window, not only in slikice/preview_*.png
+            preview_logs (str): Folder with the AHB*.XLS logs for the preview (default: the measurement folder)
+            name_suffix (str): Appended to the casi_ file name, e.g. '40p' for the tunnel percentage
+            reverse (bool): Traverse the path from its last point to its first
+            preview_probe (str): Only preview this probe of the rake (default: every probe at its sonde.json offset)
+
+        Returns:
+            str: Path of the written casi_ file
 
         Note:
             Creates measurement files in 'meritve_' directory with timestamps.
             Plays audio notification when traversal is complete.
         """
+        import tqdm
+
         lst_xyz = self.generate_path(x1,y1,x2,y2,st_x,st_y,plane)
+        if reverse:
+            lst_xyz = lst_xyz[::-1]
         child_folder_name = "meritve_"+time.strftime("%d_%m_%Y", time.localtime())
         folder_name = os.path.join('meritve',child_folder_name)
 
@@ -342,39 +357,71 @@ class Traverse:
             print(str(e))
             pass
 
-        f = open(folder_name+"/"+"casi_%s" % time.strftime("%d_%b_%Y_%H_%M_%S", time.localtime()),"w")
+        casi_path = folder_name+"/"+"casi_%s" % time.strftime("%d_%b_%Y_%H_%M_%S", time.localtime())
+        if name_suffix:
+            casi_path += "_%s" % name_suffix
+        f = open(casi_path,"w")
         print("Measuring plane made of %s points..." % str(len(lst_xyz)))
         print("List of points:",lst_xyz)
 
+        live = None
+        if preview or preview_window:
+            from datetime import datetime
+            import live_preview
+
+            planned = [(x+offset_write_x,y+offset_write_y,z+offset_write_z) for x,y,z in lst_xyz]
+            live = live_preview.PlanePreview(casi_path,planned,plane=plane,log_folder=preview_logs,window=preview_window,
+                                             probe=preview_probe)
+        # Point being measured: ((x,y,z), time of its point_start)
+        measured = None
+
         t = tqdm.tqdm(total=len(lst_xyz),bar_format="Traversing |{bar}|{n_fmt}/{total_fmt} {percentage:3.0f}% TIME:{elapsed} ETA:{remaining}")
         
         for x,y,z in lst_xyz:
             
-            mov_string = "mov_start,%s\n" % time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime())
+            mov_time = time.localtime()
+            mov_string = "mov_start,%s\n" % time.strftime("%a, %d %b %Y %H:%M:%S", mov_time)
             f.write(mov_string)
+            # Keep the file readable while it is being written (watch mode, preview).
+            f.flush()
             print(mov_string.strip())
+            if live is not None and measured is not None:
+                live.point_done(measured[0],measured[1],datetime(*mov_time[:6]))
 
             self.execute_absolute_movement(x,y,z)
             x_write = x+offset_write_x
             y_write = y+offset_write_y
             z_write = z+offset_write_z
 
-            point_start_string = "point_start,%s,%s,%s,%s\n" % (time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime()),x_write,y_write,z_write)
+            start_time = time.localtime()
+            point_start_string = "point_start,%s,%s,%s,%s\n" % (time.strftime("%a, %d %b %Y %H:%M:%S", start_time),x_write,y_write,z_write)
             f.write(point_start_string)
+            f.flush()
             print(point_start_string.strip())
 
-            time.sleep(delay)
+            if live is not None:
+                measured = ((x_write,y_write,z_write),datetime(*start_time[:6]))
+                live.wait(delay)
+            else:
+                time.sleep(delay)
             t.update()
             print('')
         t.close()
 
-        point_end_str = "point_end,%s,%s,%s,%s\n" % (time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime()),x_write,y_write,z_write )
-        f.write(point_end_str)
-        print(point_end_str.strip())
+        end_time = time.localtime()
+        # An empty path has no last point to end.
+        if lst_xyz:
+            point_end_str = "point_end,%s,%s,%s,%s\n" % (time.strftime("%a, %d %b %Y %H:%M:%S", end_time),x_write,y_write,z_write )
+            f.write(point_end_str)
+            print(point_end_str.strip())
         f.close()
+        if live is not None:
+            if measured is not None:
+                live.point_done(measured[0],measured[1],datetime(*end_time[:6]))
+            live.close()
         print('Execution finished!')
             
-        return
+        return casi_path
 
     def set_device_number(self,controller=0,number=0):
         s = "@%sG%s\r" % (controller,number)
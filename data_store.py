@@ -0,0 +1,281 @@
+"""
+Columnar binary store for the processed measurement dataset.
+
+procesiranje.get_data() produces one row per anemometer sample. Besides the
+human-readable results/all_data.csv, the same rows are written to a folder
+with one .npy file per column and a schema.json describing them:
+
+    results/all_data/
+        schema.json
+        x.npy, y.npy, z.npy          float64, traverse location [mm]
+        time.npy                     datetime64[s], time of the sample
+        velocity.npy                 float64 [m/s]
+        velocity_unit.npy            unicode
+        temperature.npy              float64 [degC]
+        temperature_unit.npy         unicode
+        percent.npy                  float64, wind tunnel percentage
+        percent_str.npy              unicode, suffix of the casi_ file
+        probe.npy                    unicode, anemometer channel (place column of the AHB*.XLS log)
+
+The .npy files are opened with numpy memory mapping, so loading the dataset
+only reads the headers; the arrays are views into the page cache.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy
+
+SCHEMA_VERSION = 2
+# Version 1 had no probe column, all its samples are from DEFAULT_PROBE.
+SUPPORTED_VERSIONS = (1, 2)
+DEFAULT_PROBE = '1'
+SCHEMA_FILE = 'schema.json'
+
+DEFAULT_COLUMNS_PATH = os.path.join('results', 'all_data')
+DEFAULT_CSV_PATH = os.path.join('results', 'all_data.csv')
+
+# (column name, dtype) in the same order as the rows returned by procesiranje.get_data()
+COLUMNS = [
+    ('x', 'float64'),
+    ('y', 'float64'),
+    ('z', 'float64'),
+    ('time', 'datetime64[s]'),
+    ('velocity', 'float64'),
+    ('velocity_unit', 'U'),
+    ('temperature', 'float64'),
+    ('temperature_unit', 'U'),
+    ('percent', 'float64'),
+    ('percent_str', 'U'),
+    ('probe', 'U'),
+]
+
+
+def rows_to_columns(rows):
+    """Convert a list of get_data() rows into a dict of typed numpy arrays.
+
+    Args:
+        rows (list): Rows in the order given by COLUMNS (without the header row)
+
+    Returns:
+        dict: column name -> numpy array
+    """
+    columns = {}
+    transposed = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+    for (name, dtype), values in zip(COLUMNS, transposed):
+        if dtype == 'U':
+            columns[name] = numpy.array([str(v).strip() for v in values], dtype=str)
+        elif dtype.startswith('datetime64'):
+            columns[name] = numpy.array(values, dtype=dtype)
+        else:
+            columns[name] = numpy.array([float(v) for v in values], dtype=dtype)
+    return columns
+
+
+def write_columns(rows, path=DEFAULT_COLUMNS_PATH):
+    """Write get_data() rows as a folder of .npy columns with a schema.
+
+    Args:
+        rows (list): Rows in the order given by COLUMNS (without the header row)
+        path (str): Output folder, created if it does not exist
+
+    Returns:
+        dict: The written schema
+    """
+    return _write_arrays(rows_to_columns(rows), path)
+
+
+def _write_arrays(columns, path):
+    os.makedirs(path, exist_ok=True)
+    # Readers must not pick up a mix of old and new columns while they are rewritten.
+    if os.path.exists(os.path.join(path, SCHEMA_FILE)):
+        os.remove(os.path.join(path, SCHEMA_FILE))
+    schema = {'version': SCHEMA_VERSION, 'length': len(columns['x']), 'columns': []}
+    for name, _ in COLUMNS:
+        array = columns[name]
+        numpy.save(os.path.join(path, name + '.npy'), array, allow_pickle=False)
+        schema['columns'].append({'name': name, 'dtype': array.dtype.str})
+
+    # Schema last, so a half written folder is never picked up as valid.
+    with open(os.path.join(path, SCHEMA_FILE), 'w') as f:
+        json.dump(schema, f, indent=1)
+    return schema
+
+
+def read_csv(path=DEFAULT_CSV_PATH):
+    """Parse all_data.csv into the same dict of arrays as load_columns().
+
+    Only used as a fallback when the binary columns are not available.
+    """
+    with open(path, 'r') as f:
+        lines = f.readlines()[1:]
+    # Every line ends with a trailing comma. Files written before the probe column get DEFAULT_PROBE.
+    rows = [line.strip()[:-1].split(',') for line in lines if line.strip()]
+    rows = [row if len(row) == len(COLUMNS) else row + [DEFAULT_PROBE] for row in rows]
+    return rows_to_columns(rows)
+
+
+def load_columns(path=DEFAULT_COLUMNS_PATH, mmap_mode='r'):
+    """Load the columnar dataset as memory-mapped numpy arrays.
+
+    Args:
+        path (str): Folder written by write_columns()
+        mmap_mode (str): Passed to numpy.load(); None reads the arrays into memory
+
+    Returns:
+        dict: column name -> numpy array (read-only views when memory mapped)
+
+    Raises:
+        ValueError: If the schema version is not supported
+    """
+    with open(os.path.join(path, SCHEMA_FILE), 'r') as f:
+        schema = json.load(f)
+    if schema.get('version') not in SUPPORTED_VERSIONS:
+        raise ValueError("Unsupported all_data schema version: %s" % schema.get('version'))
+
+    columns = {}
+    for column in schema['columns']:
+        name = column['name']
+        columns[name] = numpy.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+    if 'probe' not in columns:
+        columns['probe'] = numpy.full(schema['length'], DEFAULT_PROBE)
+    return columns
+
+
+def load_dataset(columns_path=DEFAULT_COLUMNS_PATH, csv_path=DEFAULT_CSV_PATH):
+    """Load the measurement dataset, preferring the binary columns over the CSV.
+
+    Returns:
+        dict: column name -> numpy array
+    """
+    if os.path.exists(os.path.join(columns_path, SCHEMA_FILE)):
+        return load_columns(columns_path)
+    return read_csv(csv_path)
+
+
+def group_locations(columns):
+    """Group samples by traverse location.
+
+    Returns:
+        tuple: (locations, index) where locations is an (L, 3) array of unique
+            x,y,z locations and index maps every sample to its row in locations.
+    """
+    xyz = numpy.column_stack((columns['x'], columns['y'], columns['z']))
+    locations, index = numpy.unique(xyz, axis=0, return_inverse=True)
+    return locations, index.reshape(-1)
+
+
+def dataset_files(columns_path=DEFAULT_COLUMNS_PATH, csv_path=DEFAULT_CSV_PATH):
+    """Files that load_dataset() would read, in a stable order."""
+    if os.path.exists(os.path.join(columns_path, SCHEMA_FILE)):
+        # A version 1 folder has no probe.npy.
+        arrays = [os.path.join(columns_path, name + '.npy') for name, _ in COLUMNS]
+        return [os.path.join(columns_path, SCHEMA_FILE)] + [path for path in arrays if os.path.exists(path)]
+    return [csv_path]
+
+
+def dataset_signature(columns_path=DEFAULT_COLUMNS_PATH, csv_path=DEFAULT_CSV_PATH):
+    """Cheap (path, size, mtime) signature of the dataset, changes whenever it is rewritten."""
+    signature = []
+    for path in dataset_files(columns_path, csv_path):
+        st = os.stat(path)
+        signature.append((path, st.st_size, st.st_mtime_ns))
+    return tuple(signature)
+
+
+def dataset_hash(columns_path=DEFAULT_COLUMNS_PATH, csv_path=DEFAULT_CSV_PATH):
+    """SHA-1 of the dataset contents, used to key fitted model artefacts."""
+    digest = hashlib.sha1()
+    for path in dataset_files(columns_path, csv_path):
+        digest.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_npy_header(f):
+    """(version, shape, fortran_order, dtype) of an open .npy file, positioned at its data."""
+    version = numpy.lib.format.read_magic(f)
+    if version == (1, 0):
+        return (version,) + numpy.lib.format.read_array_header_1_0(f)
+    if version == (2, 0):
+        return (version,) + numpy.lib.format.read_array_header_2_0(f)
+    raise ValueError("Unsupported .npy version %s.%s" % version)
+
+
+def _append_npy(path, array):
+    """
+    Append a 1-D array to an .npy file in place and rewrite its header.
+
+    Returns:
+        bool: False if the file can not grow in place (other dtype, wider
+        strings, or no room for the longer shape in the padded header)
+    """
+    with open(path, 'r+b') as f:
+        try:
+            version, shape, fortran_order, dtype = _read_npy_header(f)
+        except ValueError:
+            return False
+        data_start = f.tell()
+        if fortran_order or len(shape) != 1 or dtype.hasobject or dtype.kind != array.dtype.kind \
+                or array.dtype.itemsize > dtype.itemsize or (dtype.kind == 'M' and dtype != array.dtype):
+            return False
+        # magic string, version and the 2 (version 1) or 4 byte header length
+        header_start = 8 + (2 if version == (1, 0) else 4)
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+            numpy.lib.format.dtype_to_descr(dtype), shape[0] + len(array))
+        room = data_start - header_start
+        if len(header) + 1 > room:
+            return False
+        f.seek(0, os.SEEK_END)
+        if f.tell() != data_start + shape[0] * dtype.itemsize:
+            # Bytes of an interrupted append, overwritten by this one.
+            f.seek(data_start + shape[0] * dtype.itemsize)
+            f.truncate()
+        f.write(numpy.ascontiguousarray(array, dtype=dtype).tobytes())
+        # The data is in place before the header announces it.
+        f.seek(header_start)
+        f.write((header.ljust(room - 1) + '\n').encode('latin-1'))
+    return True
+
+
+def append_columns(rows, path=DEFAULT_COLUMNS_PATH):
+    """Append get_data() rows to the columnar dataset, creating it if needed.
+
+    The new values are written to the end of every .npy file and only its
+    header is rewritten, so an append costs as much as the appended rows. A
+    column is rewritten as a whole only when it can not grow in place, e.g.
+    when a string is longer than all before it or the header needs more room.
+    The schema is removed while the columns change and written last, as in
+    write_columns().
+
+    Returns:
+        dict: The written schema
+    """
+    schema_path = os.path.join(path, SCHEMA_FILE)
+    if not os.path.exists(schema_path):
+        return write_columns(rows, path)
+    with open(schema_path, 'r') as f:
+        length = json.load(f)['length']
+    new = rows_to_columns(rows)
+    os.remove(schema_path)
+    schema = {'version': SCHEMA_VERSION, 'length': length + len(rows), 'columns': []}
+    for name, _ in COLUMNS:
+        column_path = os.path.join(path, name + '.npy')
+        if not os.path.exists(column_path):
+            # A version 1 store has no probe column yet.
+            existing = numpy.full(length, DEFAULT_PROBE)
+        elif _append_npy(column_path, new[name]):
+            existing = None
+        else:
+            existing = numpy.load(column_path, allow_pickle=False)
+        if existing is not None:
+            numpy.save(column_path, numpy.concatenate((existing, new[name])), allow_pickle=False)
+        with open(column_path, 'rb') as f:
+            dtype = _read_npy_header(f)[3]
+        schema['columns'].append({'name': name, 'dtype': dtype.str})
+    with open(schema_path, 'w') as f:
+        json.dump(schema, f, indent=1)
+    return schema
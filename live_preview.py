@@ -0,0 +1,318 @@
+"""
+Live preview of a plane while Traverse.traverse_plane is measuring it.
+
+After every point the traverse hands the point's time window to a PlanePreview.
+A background thread waits until the anemometer log covers the window, reads
+only that window (xls_index.read_windows), computes the statistics of every
+probe and inserts each at its sonde.json offset from the traverse position
+into an IncrementalInterpolator. The interpolated map is
+redrawn at most every min_interval seconds into <folder>/slikice/preview_<casi>.png
+and, with window=True, into a matplotlib window that is refreshed while the
+traverse waits at a point (PlanePreview.wait replaces time.sleep). Nothing in
+the motion loop waits for the logs, the interpolation or the drawing.
+
+The figure uses the same axes as procesiranje.izrisi_povprecja (minus the two
+plane coordinates), so it can be compared with the processed plots directly.
+"""
+
+import glob
+import os
+import queue
+import threading
+import time
+
+import numpy
+
+import procesiranje
+import xls_index
+
+# Seconds close() allows for drawing the final frame.
+RENDER_TIMEOUT = 10.
+
+QUANTITIES = {
+    'avg_speed': ('Povprecna_hitrost_', 'm/s'),
+    'std_dev_speed': ('Standardni_odklon_hitrost_', 'm/s'),
+    'turbulence': ('Stopnja_turbulence_', '%'),
+    'avg_temp': ('Povprecna_temperatura_', '°C'),
+}
+
+
+class IncrementalInterpolator:
+    """
+    Piecewise linear interpolation over a Delaunay triangulation that grows one point at a time.
+
+    Inserting a point costs about as much as locating it in the triangulation,
+    instead of refitting an Rbf over all points. Until the points span a plane
+    (the first column of a traverse is a straight line) the nearest measured
+    value is used.
+    """
+
+    def __init__(self):
+        self.points = []
+        self.values = []
+        self._positions = set()
+        self._triangulation = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, point, value):
+        """
+        Insert a measured point, returns False if there already is one at that position.
+
+        Probes without a sonde.json offset share the traverse position, the first one added is kept.
+        """
+        from scipy.spatial import Delaunay
+
+        point = (float(point[0]), float(point[1]))
+        if point in self._positions:
+            return False
+        self._positions.add(point)
+        self.points.append(point)
+        self.values.append(float(value))
+        if self._triangulation is not None:
+            self._triangulation.add_points([self.points[-1]])
+        elif len(self.points) >= 3:
+            try:
+                self._triangulation = Delaunay(numpy.array(self.points), incremental=True)
+            except Exception:
+                # All points on a line so far (scipy raises QhullError).
+                self._triangulation = None
+        return True
+
+    def __call__(self, xi, yi):
+        """Interpolated values at xi, yi (arrays of the same shape), NaN outside the measured area."""
+        from scipy.interpolate import LinearNDInterpolator
+
+        xi = numpy.asarray(xi, dtype=float)
+        yi = numpy.asarray(yi, dtype=float)
+        values = numpy.array(self.values)
+        if self._triangulation is not None:
+            return LinearNDInterpolator(self._triangulation, values)(xi, yi)
+        points = numpy.array(self.points)
+        distance = (xi[..., None] - points[:, 0]) ** 2 + (yi[..., None] - points[:, 1]) ** 2
+        return values[numpy.argmin(distance, axis=-1)]
+
+
+def point_statistics(log_folder, start, end, probe=None):
+    """
+    Statistics of every probe's samples strictly between start and end, like calculate_statistics().
+
+    Args:
+        probe (str): Only this probe (default: all probes)
+
+    Returns:
+        dict: probe -> dict with avg_speed, std_dev_speed, turbulence, avg_temp
+        and n, or None if the logs do not reach end yet
+    """
+    paths = sorted(glob.glob(os.path.join(log_folder, "AHB*.XLS")))
+    end_seconds = xls_index.datetime_seconds(end)
+    if not paths or max(xls_index.get_index(path).last_time for path in paths) < end_seconds:
+        return None
+    start_seconds = xls_index.datetime_seconds(start)
+    lines = []
+    for path in paths:
+        lines += xls_index.read_windows(path, [(start, end)])
+    meritve = procesiranje.preberi_meritve(lines)
+    selected = (meritve['seconds'] > start_seconds) & (meritve['seconds'] < end_seconds)
+    if probe is not None:
+        selected &= meritve['probe'] == probe
+    probes, index = numpy.unique(meritve['probe'][selected], return_inverse=True)
+    index = index.reshape(-1)
+    speeds = meritve['velocity'][selected]
+    n = numpy.bincount(index, minlength=len(probes))
+    avg_speed = numpy.bincount(index, weights=speeds, minlength=len(probes)) / n
+    std_speed = numpy.sqrt(numpy.bincount(index, weights=(speeds - avg_speed[index]) ** 2, minlength=len(probes)) / n)
+    avg_temp = numpy.bincount(index, weights=meritve['temperature'][selected], minlength=len(probes)) / n
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        turbulence = numpy.where(avg_speed != 0, 100.0 * std_speed / avg_speed, numpy.nan)
+    return {p: {'n': int(n[k]), 'avg_speed': avg_speed[k], 'std_dev_speed': std_speed[k],
+                'turbulence': turbulence[k], 'avg_temp': avg_temp[k]}
+            for k, p in enumerate(probes.tolist())}
+
+
+class PlanePreview:
+    """
+    Incrementally updated map of one plane.
+
+    Args:
+        casi_path (str): casi_ file of the run, names the preview image
+        planned (list): All (x,y,z) points of the plane, as written to the casi_ file
+        plane (str): Plane of traverse_plane, selects the two drawn coordinates
+        log_folder (str): Folder with the AHB*.XLS logs (default: the casi_ folder)
+        quantity (str): One of QUANTITIES
+        min_interval (float): Minimum seconds between two redraws
+        window (bool): Also show the preview in a matplotlib window
+        save (bool): Write the preview image
+        probe (str): Only show this probe of the rake (default: every probe at its
+            sonde.json offset, like correlate_columns)
+    """
+
+    def __init__(self, casi_path, planned, plane='zy', log_folder=None, quantity='avg_speed',
+                 min_interval=2., window=False, save=True, probe=None):
+        if quantity not in QUANTITIES:
+            raise ValueError("Unknown preview quantity %s, use one of %s" % (quantity, ', '.join(QUANTITIES)))
+        self.casi_path = casi_path
+        self.folder = os.path.dirname(casi_path)
+        self.log_folder = log_folder or self.folder
+        self.quantity = quantity
+        self.min_interval = min_interval
+        self.window = window
+        self.save = save
+        self.probe = probe
+        self.axes = sorted('xyz'.index(a) for a in plane)
+        # Probe offsets of the measurement folder, the preview shows the probes where they measured.
+        self.offsets = procesiranje.odmiki_sond(self.folder)
+        shifts = [(0., 0., 0.)] + list(self.offsets.values()) if probe is None else [self.offsets.get(probe, (0., 0., 0.))]
+
+        planned = numpy.array([self._plot_coordinates(numpy.add(p, shift)) for p in planned for shift in shifts])
+        self.extent = [planned[:, 0].min(), planned[:, 0].max(), planned[:, 1].min(), planned[:, 1].max()]
+        self.n_planned = len(planned)
+        xi = numpy.linspace(self.extent[0], self.extent[1], 100)
+        yi = numpy.linspace(self.extent[2], self.extent[3], 100)
+        self.xi, self.yi = numpy.meshgrid(xi, yi)
+
+        self.interpolator = IncrementalInterpolator()
+        self.frame = None
+        self._frame_number = 0
+        self._shown_frame = 0
+        self._window_figure = None
+        self._queue = queue.Queue()
+        self._pending = []
+        self._running = True
+        # Set by close(): until then the points still waiting for their samples are looked for.
+        self._deadline = None
+        self._thread = threading.Thread(target=self._work, name='plane-preview', daemon=True)
+        self._thread.start()
+
+    def _plot_coordinates(self, xyz):
+        return (-xyz[self.axes[0]], -xyz[self.axes[1]])
+
+    def point_done(self, xyz, start, end):
+        """Hand over a measured point (datetimes of its window), returns immediately."""
+        self._queue.put((xyz, start, end))
+
+    def _collect(self):
+        """Move the points whose samples are logged into the interpolator, True if any were added."""
+        added = False
+        still_pending = []
+        for xyz, start, end in self._pending:
+            stats = point_statistics(self.log_folder, start, end, self.probe)
+            if stats is None:
+                still_pending.append((xyz, start, end))
+                continue
+            for probe, probe_stats in sorted(stats.items()):
+                position = numpy.add(xyz, self.offsets.get(probe, (0., 0., 0.)))
+                added = self.interpolator.add(self._plot_coordinates(position), probe_stats[self.quantity]) or added
+        self._pending = still_pending
+        return added
+
+    def _work(self):
+        dirty = False
+        last_render = 0.
+        last_collect = 0.
+        while True:
+            try:
+                self._pending.append(self._queue.get(timeout=0.2))
+                continue
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            if not self._running and (not self._pending or now >= self._deadline):
+                break
+            # The logger writes with a delay, look for the samples of pending points once a second.
+            if self._pending and now - last_collect >= 1.:
+                last_collect = now
+                dirty = self._collect() or dirty
+            if dirty and now - last_render >= self.min_interval:
+                self._render()
+                dirty = False
+                last_render = now
+        self._render()
+
+    def _render(self):
+        if not len(self.interpolator):
+            return
+        zi = self.interpolator(self.xi, self.yi)
+        points = numpy.array(self.interpolator.points)
+        values = numpy.array(self.interpolator.values)
+        self.frame = (numpy.ma.masked_invalid(zi), points, values)
+        self._frame_number += 1
+        if self.save:
+            self._save_image()
+
+    def _title(self):
+        predpona, unit = QUANTITIES[self.quantity]
+        values = self.frame[2]
+        return ('%s%s (%s/%s)' % (predpona, os.path.basename(self.casi_path), len(values), self.n_planned),
+                'Min:%.2f Max:%.2f Avg:%.2f %s' % (values.min(), values.max(), values.mean(), unit))
+
+    def _draw(self, figure):
+        import matplotlib.cm as cm
+
+        zi, points, values = self.frame
+        figure.clear()
+        ax = figure.add_subplot(1, 1, 1)
+        vmin, vmax = values.min(), values.max()
+        image = ax.imshow(zi, vmin=vmin, vmax=vmax, origin='lower', extent=self.extent, cmap=cm.jet)
+        ax.scatter(points[:, 0], points[:, 1], c=values, cmap=cm.jet, vmin=vmin, vmax=vmax, edgecolors='k')
+        figure.colorbar(image, ax=ax)
+        title, label = self._title()
+        ax.set_title(title)
+        ax.set_xlabel(label)
+
+    def _save_image(self):
+        # The Agg canvas does not touch pyplot, so it can be drawn outside the main thread.
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        self._draw(figure)
+        os.makedirs(os.path.join(self.folder, 'slikice'), exist_ok=True)
+        path = os.path.join(self.folder, 'slikice', 'preview_%s.png' % os.path.basename(self.casi_path))
+        tmp_path = path + '.tmp'
+        figure.savefig(tmp_path, format='png')
+        os.replace(tmp_path, path)
+
+    def wait(self, seconds):
+        """
+        Sleep for seconds, refreshing the preview window meanwhile if there is one.
+
+        Meant to replace time.sleep(delay) at a measurement point: the window is
+        only redrawn when a new frame is ready and there is enough time left.
+        """
+        deadline = time.monotonic() + seconds
+        if not self.window:
+            time.sleep(seconds)
+            return
+        import matplotlib.pyplot as plt
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if self._frame_number != self._shown_frame and remaining > 0.5:
+                self._shown_frame = self._frame_number
+                if self._window_figure is None:
+                    plt.ion()
+                    self._window_figure = plt.figure('Preview')
+                self._draw(self._window_figure)
+                self._window_figure.canvas.draw_idle()
+            if self._window_figure is not None:
+                plt.pause(min(remaining, 0.1))
+            else:
+                time.sleep(min(remaining, 0.1))
+
+    def close(self, timeout=5.):
+        """
+        Wait for the samples of the remaining points and draw the final frame.
+
+        The logger writes with a delay, so the last point's samples usually
+        arrive after the traverse has finished. They are looked for at most
+        timeout seconds; points still missing then are left out of the frame.
+        """
+        self._deadline = time.monotonic() + timeout
+        self._running = False
+        # Plus the time to draw the final frame.
+        self._thread.join(timeout + RENDER_TIMEOUT)
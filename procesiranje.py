@@ -1,15 +1,13 @@
-from pprint import pprint
 from datetime import datetime,timedelta
 import numpy
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm 
-from mpl_toolkits.mplot3d import Axes3D
-import scipy.interpolate
 import glob, os
-import matplotlib.colors as colors
-from matplotlib.colors import LinearSegmentedColormap
+import json
 import shutil
 import os, re, os.path
+import data_store
+import spectral
+import profiling
+import xls_index
 
 """
 Author: Miha Smrekar
@@ -19,45 +17,83 @@ in anemometra, ki shranjuje podatke v XLS datoteko.
 
 Casovno oznaceni podatki o lokaciji traverze so shranjeni v datotekah casi_[datum in cas zacetka meritve].
 Casovno oznaceni podatki merjenja so shranjeni v AHB01000.XLS, AHB01002.XLS, itd.
+Stolpec place v teh datotekah je sonda (kanal anemometra), meritve vseh sond se procesirajo skupaj.
 """
 
+# Odmiki sond od pozicije traverze, v mapi meritev (glej odmiki_sond).
+SONDE = 'sonde.json'
 
+
+@profiling.stage('calculate_averages')
 def calculate_averages(pdict):
 	"""
 	Za izdelavo output seznama tock z povprecnimi hitrostmi in ostalimi podrobnostmi
 	"""
-	output_list = []
-	all_temps = []
-	all_speeds = []
-	for k,v in pdict.items():
-		x,y,z = k
-		list_speeds = []
-		list_temps = []
-		for m in v["measurements"]:
-			speed,unit_speed,temp,unit_temp,date = m
-			list_speeds.append(speed)
-			list_temps.append(temp)
-			all_temps.append(temp)
-			all_speeds.append(speed)
-		avg_speed = numpy.average(list_speeds)
-		avg_temp = numpy.average(list_temps)
-		std_dev_speed = numpy.std(list_speeds)
-		std_dev_temp = numpy.std(list_temps)
+	kljuci = list(pdict.keys())
+	tocke = []
+	hitrosti = []
+	temperature = []
+	sonde = []
+	for i,k in enumerate(kljuci):
+		for m in pdict[k]["measurements"]:
+			tocke.append(i)
+			hitrosti.append(m[0])
+			temperature.append(m[2])
+			# Meritve brez sonde so iz starejsih knjiznic tock.
+			sonde.append(m[5] if len(m) > 5 else data_store.DEFAULT_PROBE)
+	pozicije = numpy.array(kljuci,dtype=float).reshape(-1,3)[numpy.array(tocke,dtype=numpy.int64)]
+	return calculate_statistics({'point':numpy.array(tocke,dtype=numpy.int64),
+								'probe':numpy.array(sonde,dtype=str),
+								'x':pozicije[:,0],'y':pozicije[:,1],'z':pozicije[:,2],
+								'velocity':numpy.array(hitrosti,dtype=float),
+								'temperature':numpy.array(temperature,dtype=float)})
+
+
+@profiling.stage('calculate_statistics')
+def calculate_statistics(stolpci):
+	"""
+	Povprecja in standardni odkloni za vse kombinacije tocke in sonde naenkrat (numpy.bincount).
+
+	Prejme stolpce iz correlate_columns (potrebni so point, probe, x, y, z, velocity in temperature)
+	in vrne enak slovar kot calculate_averages; elementi output_list imajo se kljuc "probe".
+	"""
+	sonde, indeks_sonde = numpy.unique(stolpci['probe'],return_inverse=True)
+	skupina = stolpci['point']*len(sonde)+indeks_sonde.reshape(-1)
+	skupine, prvi, indeks, n = numpy.unique(skupina,return_index=True,return_inverse=True,return_counts=True)
+	indeks = indeks.reshape(-1)
+
+	def povprecje_in_odklon(vrednosti):
+		povprecje = numpy.bincount(indeks,weights=vrednosti,minlength=len(skupine))/n
+		odklon = numpy.sqrt(numpy.bincount(indeks,weights=(vrednosti-povprecje[indeks])**2,minlength=len(skupine))/n)
+		return povprecje, odklon
+
+	avg_speed, std_dev_speed = povprecje_in_odklon(stolpci['velocity'])
+	avg_temp, std_dev_temp = povprecje_in_odklon(stolpci['temperature'])
+	with numpy.errstate(invalid='ignore',divide='ignore'):
 		turbulence = 100.0*std_dev_speed/avg_speed
+
+	output_list = []
+	for x,y,z,sonda,v,t,sv,st,tu in zip(stolpci['x'][prvi].tolist(),stolpci['y'][prvi].tolist(),
+			stolpci['z'][prvi].tolist(),stolpci['probe'][prvi].tolist(),avg_speed,avg_temp,
+			std_dev_speed,std_dev_temp,turbulence):
 		output_list.append({
 							"x":x,
 							"y":y,
 							"z":z,
-							"avg_speed":avg_speed,
-							"avg_temp":avg_temp,
-							"std_dev_speed":std_dev_speed,
-							"std_dev_temp":std_dev_temp,
-							"turbulence":turbulence
+							"probe":sonda,
+							"avg_speed":v,
+							"avg_temp":t,
+							"std_dev_speed":sv,
+							"std_dev_temp":st,
+							"turbulence":tu
 							})
-	global_speed = numpy.average(all_speeds)
-	global_temp = numpy.average(all_temps)
-	global_speed_std = numpy.std(all_speeds)
-	global_temp_std = numpy.std(all_temps)
+	if len(stolpci['velocity']):
+		global_speed = numpy.average(stolpci['velocity'])
+		global_temp = numpy.average(stolpci['temperature'])
+		global_speed_std = numpy.std(stolpci['velocity'])
+		global_temp_std = numpy.std(stolpci['temperature'])
+	else:
+		global_speed = global_temp = global_speed_std = global_temp_std = numpy.nan
 	return {"output_list":output_list,
 			"global_speed":global_speed,
 			"global_temp":global_temp,
@@ -68,6 +104,23 @@ def calculate_averages(pdict):
 
 def izrisi_tocke(points_dict,traverse_locations,MAPA_MERITVE,prikazi=False,shrani=True):
 	list_points = calculate_averages(points_dict)
+	izrisi_povprecja(list_points,traverse_locations,MAPA_MERITVE,prikazi,shrani)
+
+
+def izrisi_povprecja(list_points,traverse_locations,MAPA_MERITVE,prikazi=False,shrani=True,oznaka=''):
+	"""
+	Izrise slike iz ze izracunanih povprecij (izhod calculate_averages ali calculate_statistics).
+	Vse sonde so na isti sliki, na svojih pozicijah; oznaka se doda imenom slik.
+	"""
+	izhod = list_points["output_list"]
+	sonde = sorted(set(l.get("probe",data_store.DEFAULT_PROBE) for l in izhod))
+	if len(sonde) > 1 and len(set((l["y"],l["z"]) for l in izhod)) < len(izhod):
+		# Vec sond na istih pozicijah (sonde.json nima njihovih odmikov): vsaka sonda dobi svoje slike.
+		for sonda in sonde:
+			izbrane = [l for l in izhod if l.get("probe",data_store.DEFAULT_PROBE) == sonda]
+			izrisi_povprecja({"output_list":izbrane},traverse_locations,MAPA_MERITVE,prikazi,shrani,oznaka='sonda%s_' % sonda)
+		return
+
 	# Vzami primerne x,y,z tocke za graf.
 	#     Ker je 0,0 traverze v resnici 1000,1000, damo spredaj minus, da zgleda graf pravilno.
 	
@@ -92,6 +145,7 @@ def izrisi_tocke(points_dict,traverse_locations,MAPA_MERITVE,prikazi=False,shran
 		elif i == "turbulence":
 			predpona = "Stopnja_turbulence_"
 			unit = '%'
+		predpona += oznaka
 
 		draw_to_matplotlib(
 			x=x,
@@ -121,7 +175,13 @@ def izrisi_tocke(points_dict,traverse_locations,MAPA_MERITVE,prikazi=False,shran
 				unit=unit)
 
 
+@profiling.stage('draw_to_matplotlib')
 def draw_to_matplotlib(x,y,z,traverse_locations,MAPA_MERITVE,predpona,prikazi,shrani,save_folder,absolute_scale=False,absolute_min=0,absolute_max=30,unit=''):
+	# matplotlib in scipy uvozimo sele tukaj, da je uvoz modula za delo s CSV hiter.
+	import matplotlib.pyplot as plt
+	import matplotlib.cm as cm
+	import scipy.interpolate
+
 	# Ne vem ali je to potrebno. Menda je.
 	x = numpy.array(x)
 	y = numpy.array(y)
@@ -168,14 +228,17 @@ def draw_to_matplotlib(x,y,z,traverse_locations,MAPA_MERITVE,predpona,prikazi,sh
 		plt.clf()
 
 
-def seznam_tock(traverse_locations):
+@profiling.stage('seznam_tock')
+def seznam_tock(traverse_locations,izpis=True):
 	"""
 	Funkcija prejme ime datoteke, ki ima notri spravljene case premikov in ustavitev traverze.
+	Z izpis=False ime datoteke ni izpisano (watch jo bere ob vsakem preverjanju).
 
 	Vrne pa knjiznico tock brez meritev.
 	"""
 
-	print(traverse_locations)
+	if izpis:
+		print(traverse_locations)
 
 	# Odpri datoteko od seznama lokacij
 	f_locations = open(traverse_locations,"r")
@@ -220,6 +283,7 @@ def seznam_tock(traverse_locations):
 	
 
 
+@profiling.stage('get_point_from_time')
 def get_point_from_time(points_dict):
 	"""
 	Funkcija prejme knjiznico tock.
@@ -228,75 +292,151 @@ def get_point_from_time(points_dict):
 		-vstavis cas (datetime object),
 		-dobis tocko v obliki tuple-a (x,y,z), ce je traverza v tistem trenutku mirovala,
 			sicer None.
+	Tocko poisce z bisekcijo po zacetkih tock, kot prirejene_meritve.
 	"""
-
-	# Zgeneriraj back-search seznam, s pomocjo katerega potem searchamo kateri tocki pripada cas
-
-	start_times = []
-	end_times = []
-	#print(points_dict)
-
-	for k,v in points_dict.items():
-		#print(v)
-		start = v["srt_point"]
-		start_times.append((start,k))
-		end = v["end_point"]
-		end_times.append((end,k))
-
-	sorted(start_times)
-	sorted(end_times)
+	kljuci = list(points_dict.keys())
+	zacetki = numpy.array([xls_index.datetime_seconds(v["srt_point"]) for v in points_dict.values()],dtype=numpy.int64)
+	konci = numpy.array([xls_index.datetime_seconds(v["end_point"]) for v in points_dict.values()],dtype=numpy.int64)
 
 	def search(datetime_obj):
-		i=0
-		for t in start_times:
-			if datetime_obj > start_times[i][0] and datetime_obj < end_times[i][0]:
-				return start_times[i][1]
-			i=i+1
-		return None
+		sekunde = xls_index.datetime_seconds(datetime_obj)+datetime_obj.microsecond/1e6
+		i = _tocke_ob_casih(zacetki,konci,numpy.array([sekunde]))[0]
+		return kljuci[i] if i >= 0 else None
 	return search
 
 
+@profiling.stage('tockam_dodaj_meritve')
 def tockam_dodaj_meritve(points_dict,MAPA_MERITVE):
 	"""
 	Funkcija prejme knjiznico tock, ki nimajo dodanih meritev in funkcijo, ki ti za dani cas vrne pozicijo koordinatke.
 	Vrne dopolnjeno knjiznico tock z meritvami.
 	"""
+	kljuci = list(points_dict.keys())
+	meritve, tocke = prirejene_meritve(points_dict,MAPA_MERITVE)
+	casi = xls_index.seconds_to_datetime64(meritve['seconds']).astype(object)
+
+	# Shrani vse izmerjene merilne tocke v shrambo tock
+	for i,hitrost,enota_hitrosti,temperatura,enota_temperature,cas,sonda in zip(
+			tocke.tolist(),meritve['velocity'].tolist(),meritve['velocity_unit'].tolist(),
+			meritve['temperature'].tolist(),meritve['temperature_unit'].tolist(),casi,meritve['probe'].tolist()):
+		points_dict[kljuci[i]]["measurements"].append((hitrost,enota_hitrosti,temperatura,enota_temperature,cas,sonda))
+	return points_dict
 
 
-	# Odpri datoteko od anemometra
+def prirejene_meritve(points_dict,MAPA_MERITVE):
+	"""
+	Prebere meritve vseh sond, ki casovno pokrivajo tocke, in jih priredi tockam (vse naenkrat, z numpy).
+
+	Vrne (meritve, tocke):
+		meritve: slovar numpy seznamov kot preberi_meritve, samo za meritve, ki pripadajo neki tocki
+		tocke: indeks tocke (v vrstnem redu points_dict) za vsako meritev
+	Meritve so urejene po tockah, znotraj tocke pa v vrstnem redu iz datotek.
+	"""
+	# Iz datotek od anemometra preberi samo dele, ki casovno pokrivajo tocke (glej xls_index).
 	all_lines = []
+	okna = [(v["srt_point"],v["end_point"]) for v in points_dict.values()]
 
 	for xls_meritve in glob.glob(os.path.join(MAPA_MERITVE,"AHB*.XLS")):
 		#print(xls_meritve)
-		f_measurements = open(xls_meritve)
-		lines = f_measurements.readlines()
+		profiling.count('xls_files')
+		lines = xls_index.read_windows(xls_meritve,okna)
 		all_lines += lines
 
+	profiling.count('xls_lines',len(all_lines))
+	meritve = preberi_meritve(all_lines)
 
-	get_location = get_point_from_time(points_dict)
+	# Meritev pripada tocki, ce je bila izmerjena strogo med njenim zacetkom in koncem.
+	zacetki = numpy.array([xls_index.datetime_seconds(o[0]) for o in okna],dtype=numpy.int64)
+	konci = numpy.array([xls_index.datetime_seconds(o[1]) for o in okna],dtype=numpy.int64)
+	tocke = _tocke_ob_casih(zacetki,konci,meritve['seconds'])
+	izbrane = numpy.flatnonzero(tocke >= 0)
+	izbrane = izbrane[numpy.argsort(tocke[izbrane],kind='stable')]
+	return {ime:stolpec[izbrane] for ime,stolpec in meritve.items()}, tocke[izbrane]
 
-	# Shrani vse izmerjene merilne tocke v shrambo tock
-	i=0
-	for l in all_lines:
-		if not "Date" in l and not "Time" in l:
-			place,date,time,value_speed,unit_speed,value_temp,unit_temp = l.split("\t")
-			value_speed = value_speed.replace('"',"")
-			value_speed = value_speed.replace(",",".")
-			value_temp = value_temp.replace('"',"")
-			value_temp = value_temp.replace(",",".")
-			date_time = date+" "+time
+
+def _tocke_ob_casih(zacetki,konci,sekunde):
+	"""
+	Indeks tocke, med zacetkom in koncem katere (strogo) je bil izmerjen vsak cas, ali -1.
+	Vsi casi so v sekundah kot xls_index.parse_xls_seconds.
+	"""
+	if len(zacetki) == 0:
+		return numpy.full(len(sekunde),-1,dtype=numpy.int64)
+	po_zacetkih = numpy.argsort(zacetki,kind='stable')
+	i = numpy.searchsorted(zacetki[po_zacetkih],sekunde,side='right')-1
+	kandidat = po_zacetkih[numpy.maximum(i,0)]
+	notri = (i >= 0) & (sekunde > zacetki[kandidat]) & (sekunde < konci[kandidat])
+	return numpy.where(notri,kandidat,-1)
+
+
+def preberi_meritve(lines):
+	"""
+	Vektorizirana razlicica preberi_meritev za seznam vrstic iz XLS datotek anemometra.
+
+	Vrne slovar numpy seznamov z enim elementom na meritev:
+		'probe' (sonda, stolpec place), 'seconds' (glej xls_index.parse_xls_seconds),
+		'velocity', 'velocity_unit', 'temperature', 'temperature_unit'.
+	Vrstice z glavo ter nepopolne in pokvarjene vrstice izpusti.
+	"""
+	polja = [l.split("\t") for l in lines if not ("Date" in l or "Time" in l)]
+	slabe = sum(1 for p in polja if len(p) != 7)
+	polja = [p for p in polja if len(p) == 7]
+	try:
+		meritve = _meritve_iz_polj(polja)
+	except ValueError:
+		# Pokvarjene vrstice (npr. napol zapisano zadnjo vrstico) poisci eno po eno.
+		dobre = []
+		for p in polja:
 			try:
-				#ocitno je mozno da naprava shranjuje v obeh formatih, kakor ji sede
-				date_obj = datetime.strptime(date_time,'%Y/%m/%d %H:%M:%S')
+				preberi_meritev("\t".join(p))
+				dobre.append(p)
 			except ValueError:
-				date_obj = datetime.strptime(date_time,'%m/%d/%Y %H:%M:%S')
-			
-			a = get_location(date_obj)
-			if a != None:
-				points_dict[a]["measurements"].append((float(value_speed),unit_speed,float(value_temp),unit_temp,date_obj))
-	return points_dict
+				pass
+		slabe += len(polja)-len(dobre)
+		meritve = _meritve_iz_polj(dobre)
+	profiling.count('xls_bad_lines',slabe)
+	return meritve
+
+
+def _meritve_iz_polj(polja):
+	if not polja:
+		prazen = numpy.zeros(0)
+		return {'probe':prazen.astype(str),'seconds':prazen.astype(numpy.int64),'velocity':prazen,
+				'velocity_unit':prazen.astype(str),'temperature':prazen,'temperature_unit':prazen.astype(str)}
+	place,date,time,value_speed,unit_speed,value_temp,unit_temp = (numpy.array(stolpec) for stolpec in zip(*polja))
+
+	def stevilo(vrednosti):
+		return numpy.char.replace(numpy.char.replace(vrednosti,'"',''),',','.').astype(float)
 
+	return {'probe':numpy.char.strip(place),
+			'seconds':xls_index.parse_xls_seconds_array(date,time),
+			'velocity':stevilo(value_speed),
+			'velocity_unit':unit_speed,
+			'temperature':stevilo(value_temp),
+			'temperature_unit':unit_temp}
 
+
+def preberi_meritev(l):
+	"""
+	Funkcija prejme vrstico iz XLS datoteke anemometra.
+	Vrne (place,date_obj,hitrost,enota,temperatura,enota), za vrstice z glavo pa None.
+	"""
+	if "Date" in l or "Time" in l:
+		return None
+	place,date,time,value_speed,unit_speed,value_temp,unit_temp = l.split("\t")
+	value_speed = value_speed.replace('"',"")
+	value_speed = value_speed.replace(",",".")
+	value_temp = value_temp.replace('"',"")
+	value_temp = value_temp.replace(",",".")
+	date_time = date+" "+time
+	try:
+		#ocitno je mozno da naprava shranjuje v obeh formatih, kakor ji sede
+		date_obj = datetime.strptime(date_time,'%Y/%m/%d %H:%M:%S')
+	except ValueError:
+		date_obj = datetime.strptime(date_time,'%m/%d/%Y %H:%M:%S')
+	return place,date_obj,float(value_speed),unit_speed,float(value_temp),unit_temp
+
+
+@profiling.stage('correlate_data')
 def correlate_data(traverse_locations,MAPA_MERITVE):
 	"""
 	Funkcija prejme ime datoteke, ki vsebuje lokacije traverze.
@@ -311,7 +451,8 @@ def correlate_data(traverse_locations,MAPA_MERITVE):
 	                               	  'm/S     ',
 	                                  12.5,
 	                                  'AMTemp C\n',
-	                                  datetime.datetime(2019, 1, 25, 11, 39, 54)),
+	                                  datetime.datetime(2019, 1, 25, 11, 39, 54),
+	                                  '1'),
 	                 'srt_point': datetime.datetime(2019, 1, 25, 11, 39, 53)}}
 
 	(0,0,0) je primarni kljuc knjiznice. Oznacuje x,y,z lokacijo traverze.
@@ -320,7 +461,7 @@ def correlate_data(traverse_locations,MAPA_MERITVE):
 		'srt_point' : vsebuje datetime object, ki oznacuje prvi trenutek, ko je traverza prispela na dano lokacijo.
 		'end_point' : vsebuje datetime object, ki oznacuje trenutek, ko se je traverza zacela premikati na drugo lokacijo.
 		'measurements' : pa je seznam tupleov, ki vsebujejo:
-			[(float) hitrost vetra, (str) enota, (float) temperaturo, (str) enoto, (datetime obj) cas meritve]
+			[(float) hitrost vetra, (str) enota, (float) temperaturo, (str) enoto, (datetime obj) cas meritve, (str) sonda]
 	"""
 
 	points_dict = seznam_tock(traverse_locations)
@@ -331,34 +472,73 @@ def correlate_data(traverse_locations,MAPA_MERITVE):
 
 
 
+@profiling.stage('correlate_columns')
+def correlate_columns(traverse_locations,MAPA_MERITVE):
+	"""
+	Kot correlate_data, vendar za vse sonde naenkrat vrne slovar numpy seznamov z enim elementom na meritev:
+		'point' : indeks lokacije traverze v 'locations' ((P,3) seznam v vrstnem redu iz seznam_tock)
+		'x','y','z' : pozicija sonde, lokacija traverze + odmik sonde iz sonde.json
+		'time' : datetime64[s] cas meritve
+		'probe','velocity','velocity_unit','temperature','temperature_unit' : kot preberi_meritve
+	"""
+	points_dict = seznam_tock(traverse_locations)
+	meritve, tocke = prirejene_meritve(points_dict,MAPA_MERITVE)
+	locations = numpy.array(list(points_dict.keys()),dtype=float).reshape(-1,3)
+
+	odmiki = odmiki_sond(MAPA_MERITVE)
+	sonde, indeks_sonde = numpy.unique(meritve['probe'],return_inverse=True)
+	odmik = numpy.array([odmiki.get(s,(0.,0.,0.)) for s in sonde],dtype=float).reshape(-1,3)[indeks_sonde.reshape(-1)]
+	pozicije = locations[tocke]+odmik
+
+	stolpci = dict(meritve)
+	stolpci['time'] = xls_index.seconds_to_datetime64(stolpci.pop('seconds'))
+	stolpci.update({'locations':locations,'point':tocke,'x':pozicije[:,0],'y':pozicije[:,1],'z':pozicije[:,2]})
+	return stolpci
+
+
+def odmiki_sond(MAPA_MERITVE):
+	"""
+	Odmiki sond na grabljah od pozicije traverze, iz datoteke MAPA_MERITVE/sonde.json (v mm), npr.:
+		{"1": [0, 0, 0], "2": [0, 0, 100]}
+	Vrne slovar sonda -> (dx,dy,dz); sonde, ki jih ni v datoteki (ali datoteke ni), so brez odmika.
+	"""
+	pot = os.path.join(MAPA_MERITVE,SONDE)
+	if not os.path.exists(pot):
+		return {}
+	with open(pot) as f:
+		return {str(sonda):tuple(float(o) for o in odmik) for sonda,odmik in json.load(f).items()}
+
+
 def izris(MAPA_MERITVE):
 	for file in glob.glob(os.path.join(MAPA_MERITVE,"casi_*")):
-	    correlated_data = correlate_data(file,MAPA_MERITVE)
-	    izrisi_tocke(correlated_data,file,MAPA_MERITVE)
+	    stolpci = correlate_columns(file,MAPA_MERITVE)
+	    izrisi_povprecja(calculate_statistics(stolpci),file,MAPA_MERITVE)
+
+# Glava results/all_data.csv, v vrstnem redu stolpcev iz get_data().
+GLAVA_CSV = ['x','y','z','time','velocity','velocity unit','temperature','temperature unit','percent wind tunnel','string comment','probe']
 
+@profiling.stage('get_data')
 def get_data(MAPA_MERITVE):
 	out_list = []
 	for file in glob.glob(os.path.join(MAPA_MERITVE,"casi_*")):
-	    correlated_data = correlate_data(file,MAPA_MERITVE)
+	    stolpci = correlate_columns(file,MAPA_MERITVE)
 	    head, tail = os.path.split(file)
 	    percent = tail.split('_')[-1]
 	    percent_num = percent.split('p')[0]
-	    #print(correlated_data)
-	    for loc, d in correlated_data.items():
-	    	for m in d['measurements']:
-	    		x = loc[0]
-	    		y = loc[1]
-	    		z = loc[2]
-	    		vel = m[0]
-	    		vel_unit = m[1]
-	    		temp = m[2]
-	    		temp_unit = m[3]
-	    		time = m[4]
-	    		out_list.append([x,y,z,time,vel,vel_unit.strip(),temp,temp_unit.strip(),percent_num,percent])
+	    n = len(stolpci['velocity'])
+	    out_list += map(list,zip(stolpci['x'].tolist(),stolpci['y'].tolist(),stolpci['z'].tolist(),
+	    	stolpci['time'].astype(object),stolpci['velocity'].tolist(),
+	    	numpy.char.strip(stolpci['velocity_unit']).tolist(),stolpci['temperature'].tolist(),
+	    	numpy.char.strip(stolpci['temperature_unit']).tolist(),[percent_num]*n,[percent]*n,
+	    	stolpci['probe'].tolist()))
 	return out_list
 
-def write_file_csv(lst,filename = os.path.join('results','all_data.csv')):
-	f = open(filename,'w')
+@profiling.stage('write_file_csv')
+def write_file_csv(lst,filename = os.path.join('results','all_data.csv'),mode='w'):
+	"""
+	Zapise vrstice v CSV, z mode='a' jih doda na konec obstojece datoteke.
+	"""
+	f = open(filename,mode)
 	for l in lst:
 		for thing in l:
 			f.write(str(thing))
@@ -366,25 +546,34 @@ def write_file_csv(lst,filename = os.path.join('results','all_data.csv')):
 		f.write('\n')
 	f.close()
 
+@profiling.stage('write_file_columns')
+def write_file_columns(lst,path = data_store.DEFAULT_COLUMNS_PATH):
+	"""
+	Zapise vrstice iz get_data() (brez glave) v binarni stolpcni format (glej data_store).
+	"""
+	return data_store.write_columns(lst,path)
+
 def empty_folder(mypath):
 	for root, dirs, files in os.walk(mypath):
 	    for file in files:
 	        os.remove(os.path.join(root, file))
 
-if __name__ == "__main__":
-	generate_data = True
-	make_pictures = True
-
+def procesiraj_vse(MAPA='meritve',generate_data=True,make_pictures=True,write_csv=True,spectral_analysis=True):
+	"""
+	Sprocesira vse mape meritve_* v MAPA: izrise slike in zapise results/all_data (in all_data.csv).
+	write_csv: cloveku berljiv izvoz, poleg binarnega results/all_data/
+	spectral_analysis: spektri, avtokorelacija in integralne skale tock v results/spectral_analysis.* (glej spectral.py)
+	"""
 	if generate_data:
 		all_out = []
-		all_out.append(['x','y','z','time','velocity','velocity unit','temperature','temperature unit','percent wind tunnel','string comment'])
+		all_out.append(GLAVA_CSV)
 	
 	if make_pictures:
 		empty_folder(os.path.join('results','slikice_skupaj'))
 		empty_folder(os.path.join('results','slikice_absolute_skupaj'))
 
 
-	for folder in glob.glob(os.path.join('meritve',"meritve_*")):
+	for folder in glob.glob(os.path.join(MAPA,"meritve_*")):
 		if make_pictures:
 			empty_folder(os.path.join(folder,'slikice'))
 			empty_folder(os.path.join(folder,'slikice_absolute'))
@@ -400,4 +589,12 @@ if __name__ == "__main__":
 			out = get_data(folder)
 			all_out += out
 
-	write_file_csv(all_out)
+	if generate_data:
+		write_file_columns(all_out[1:])
+		if write_csv:
+			write_file_csv(all_out)
+		if spectral_analysis:
+			spectral.run()
+
+if __name__ == "__main__":
+	procesiraj_vse()
@@ -0,0 +1,217 @@
+"""
+Lightweight stage profiling for the acquisition and processing pipeline.
+
+Pipeline functions are wrapped with @profiling.stage("name"). While profiling is
+disabled the wrapper only checks a module global and calls through. When it is
+enabled, every stage records its call count, total and maximum wall time and,
+with the "memory" mode, the peak traced memory while it ran. Counters
+(e.g. number of parsed samples) are added with profiling.count().
+
+Profiling is enabled with the TRAVERSE_PROFILE=MODE environment variable or
+`traverse --profile [--profile-mode MODE] ...`. MODE is a comma separated list of:
+
+    timers       stage timers and counters (always on when profiling)
+    memory       peak memory per stage with tracemalloc (slows the run down)
+    cprofile     also capture a cProfile of the whole run (<trace>.prof)
+    pyinstrument also capture a pyinstrument profile (<trace>.html), if installed
+
+"1" is short for "timers,memory". At exit a JSON trace is written to
+TRAVERSE_PROFILE_OUT or results/profile_<date>_<time>.json.
+"""
+
+import atexit
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ENV_VAR = 'TRAVERSE_PROFILE'
+ENV_OUT = 'TRAVERSE_PROFILE_OUT'
+MODES = ('timers', 'memory', 'cprofile', 'pyinstrument')
+
+_profiler = None
+
+
+class Profiler:
+    """Collects stage timings, counters and peak memory of one run."""
+
+    def __init__(self, modes=('timers',), trace_path=None):
+        self.modes = set(modes) | {'timers'}
+        self.trace_path = trace_path or os.path.join(
+            'results', 'profile_%s.json' % time.strftime('%Y%m%d_%H%M%S', time.localtime()))
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        # Peak memory of the stages currently running, innermost last.
+        self._memory_stack = []
+        self._cprofile = None
+        self._pyinstrument = None
+
+        if 'memory' in self.modes and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if 'cprofile' in self.modes:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        if 'pyinstrument' in self.modes:
+            try:
+                import pyinstrument
+            except ImportError:
+                print("pyinstrument is not installed, skipping pyinstrument capture", file=sys.stderr)
+            else:
+                self._pyinstrument = pyinstrument.Profiler()
+                self._pyinstrument.start()
+
+    def enter(self):
+        if 'memory' in self.modes:
+            # The enclosing stage keeps the peak reached so far, the new one starts from zero.
+            current, peak = tracemalloc.get_traced_memory()
+            if self._memory_stack:
+                self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+            # reset_peak() is new in Python 3.9, before that the peak covers the whole run.
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self._memory_stack.append([current, current])
+        return time.perf_counter()
+
+    def exit(self, name, start):
+        elapsed = time.perf_counter() - start
+        stats = self.stages.setdefault(name, {'calls': 0, 'total_s': 0., 'max_s': 0.})
+        stats['calls'] += 1
+        stats['total_s'] += elapsed
+        stats['max_s'] = max(stats['max_s'], elapsed)
+
+        if 'memory' in self.modes and self._memory_stack:
+            current, peak = tracemalloc.get_traced_memory()
+            start_memory, child_peak = self._memory_stack.pop()
+            peak = max(peak, child_peak)
+            # Absolute peak of traced memory, and how much the stage allocated on top of its start.
+            stats['peak_memory_bytes'] = max(stats.get('peak_memory_bytes', 0), peak)
+            stats['peak_allocated_bytes'] = max(stats.get('peak_allocated_bytes', 0), peak - start_memory)
+            if self._memory_stack:
+                self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def trace(self):
+        """The collected data as a JSON serialisable dict."""
+        trace = {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                 'wall_time_s': time.time() - self.started,
+                 'modes': sorted(self.modes),
+                 'argv': sys.argv,
+                 'stages': self.stages,
+                 'counters': self.counters}
+        if tracemalloc.is_tracing():
+            trace['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        return trace
+
+    def write(self):
+        """Write the JSON trace and the optional cProfile/pyinstrument captures."""
+        folder = os.path.dirname(self.trace_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        base = os.path.splitext(self.trace_path)[0]
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(base + '.prof')
+        if self._pyinstrument is not None:
+            self._pyinstrument.stop()
+            with open(base + '.html', 'w') as f:
+                f.write(self._pyinstrument.output_html())
+        with open(self.trace_path, 'w') as f:
+            json.dump(self.trace(), f, indent=1)
+        return self.trace_path
+
+
+def parse_modes(value):
+    """Modes from a TRAVERSE_PROFILE / --profile value."""
+    if value in ('', '0'):
+        return ()
+    if value == '1':
+        return ('timers', 'memory')
+    modes = tuple(m.strip() for m in value.split(',') if m.strip())
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        raise ValueError("Unknown profiling mode(s): %s" % ', '.join(sorted(unknown)))
+    return modes
+
+
+def enable(modes=('timers', 'memory'), trace_path=None):
+    """Start profiling this run, the trace is written at interpreter exit."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(modes, trace_path)
+        atexit.register(_write_at_exit)
+    return _profiler
+
+
+def disable():
+    """Stop profiling and write the trace now. Returns the trace path or None."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    return profiler.write()
+
+
+def is_enabled():
+    return _profiler is not None
+
+
+def _write_at_exit():
+    path = disable()
+    if path:
+        print("Profile trace written to %s" % path, file=sys.stderr)
+
+
+def count(name, n=1):
+    """Add n to a named counter, a no-op while profiling is disabled."""
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self._starts = []
+
+    def __enter__(self):
+        if _profiler is not None:
+            self._starts.append((_profiler, _profiler.enter()))
+        else:
+            self._starts.append(None)
+        return self
+
+    def __exit__(self, *exc):
+        started = self._starts.pop()
+        if started is not None:
+            profiler, start = started
+            profiler.exit(self.name, start)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            start = profiler.enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.exit(self.name, start)
+        return wrapper
+
+
+def stage(name):
+    """Decorator and context manager that times a named pipeline stage."""
+    return _Stage(name)
+
+
+if os.environ.get(ENV_VAR):
+    _modes = parse_modes(os.environ[ENV_VAR])
+    if _modes:
+        enable(_modes, os.environ.get(ENV_OUT))
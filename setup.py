@@ -18,15 +18,13 @@ setup(
     author_email='',  # Removed for privacy
     url='https://github.com/mihasm/traverse-control-',
     packages=find_packages(),
-    py_modules=['commands', 'procesiranje', 'wind_interpolation'],
+    py_modules=['commands', 'procesiranje', 'wind_interpolation', 'data_store', 'wind_field', 'wind_server', 'cli', 'profiling', 'xls_index', 'watch', 'live_preview', 'campaign', 'spectral'],
     include_package_data=True,
     install_requires=[
         'pyserial>=3.0',
         'numpy>=1.19.0',
         'scipy>=1.5.0',
         'matplotlib>=3.3.0',
-        'mpldatacursor>=0.7',
-        'sympy>=1.6.0',
         'tqdm>=4.50.0',
     ],
     classifiers=[
@@ -47,6 +45,7 @@ setup(
     entry_points={
         'console_scripts': [
             'traverse-init=commands:initialize_system',
+            'traverse=cli:main',
         ],
     },
 )
\ No newline at end of file
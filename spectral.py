@@ -0,0 +1,256 @@
+"""
+Spectral turbulence analysis of the per-point velocity time series.
+
+calculate_averages() reduces every point to a mean, a standard deviation and a
+turbulence intensity. This stage keeps the temporal information: for every
+measured point and probe (a contiguous series of samples of one probe at one
+location in one run) it computes
+
+    psd                  Welch power spectral density [(m/s)^2/Hz]
+    autocorrelation      normalised autocorrelation up to max_lag samples
+    integral_time_s      integral time scale, the autocorrelation integrated to its first zero
+    integral_length_m    integral length scale, integral_time_s * avg_speed (Taylor)
+    reverse_arrangement  z score of the reverse arrangement test on block means,
+                         stationary is |z| < 1.96 (5 % significance)
+
+All points are processed together: the Welch segments of every point are
+gathered into one matrix and transformed with a single rfft call, and the
+autocorrelations use one zero-padded FFT per block of points.
+
+The input is the columnar dataset (data_store.load_dataset()); the results are
+written to results/spectral_analysis.csv (one row per point, next to
+results/all_data.csv) and results/spectral_analysis.npz (with the spectra).
+"""
+
+import os
+
+import numpy
+
+import data_store
+import profiling
+
+DEFAULT_CSV_PATH = os.path.join('results', 'spectral_analysis.csv')
+DEFAULT_NPZ_PATH = os.path.join('results', 'spectral_analysis.npz')
+
+# Samples further apart than this are not the same point measurement [s].
+MAX_GAP = 5.
+# Number of blocks of the reverse arrangement test.
+STATIONARITY_BLOCKS = 10
+# Upper bound of the number of float64 values in one FFT batch.
+BATCH_VALUES = 1 << 22
+
+METRICS = ['x', 'y', 'z', 'probe', 'percent', 'percent_str', 'start', 'samples', 'sample_rate_hz',
+           'avg_speed', 'std_dev_speed', 'turbulence', 'integral_time_s', 'integral_length_m',
+           'reverse_arrangement', 'stationary']
+
+
+def point_series(columns, max_gap=MAX_GAP):
+    """
+    Split the dataset into the time series of the measured points.
+
+    Returns:
+        tuple: (order, starts, lengths), order sorts the dataset so that every
+        point is the contiguous slice starts[i]:starts[i]+lengths[i]
+    """
+    time = columns['time'].astype('datetime64[s]').astype(numpy.int64)
+    order = numpy.lexsort((time, columns['probe'], columns['percent_str'], columns['z'], columns['y'], columns['x']))
+    if len(order) == 0:
+        return order, numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    new = numpy.zeros(len(order), dtype=bool)
+    new[0] = True
+    for name in ('x', 'y', 'z', 'percent_str', 'probe'):
+        values = columns[name][order]
+        new[1:] |= values[1:] != values[:-1]
+    new[1:] |= numpy.diff(time[order]) > max_gap
+    starts = numpy.flatnonzero(new)
+    lengths = numpy.diff(numpy.append(starts, len(order)))
+    return order, starts, lengths
+
+
+def sample_rates(time, starts, lengths):
+    """
+    Samples per second of every point, from its whole-second timestamps.
+
+    The first and last second of a point are only partly measured, so they are
+    left out: the rate is the number of samples in the seconds between them
+    divided by the number of those seconds. Points spanning at most two
+    seconds use their samples per distinct second.
+    """
+    if len(starts) == 0:
+        return numpy.ones(0)
+    owner = numpy.repeat(numpy.arange(len(starts)), lengths)
+    first = time[starts]
+    last = time[starts + lengths - 1]
+    # The series are consecutive slices covering time, as returned by point_series().
+    edge = (time == first[owner]) | (time == last[owner])
+    interior = lengths - numpy.bincount(owner, weights=edge, minlength=len(starts))
+    seconds = (last - first - 1).astype(float)
+    rates = lengths / (last - first + 1).astype(float)
+    long_enough = seconds >= 1
+    rates[long_enough] = interior[long_enough] / seconds[long_enough]
+    return rates
+
+
+def welch(values, starts, lengths, fs, nperseg=64):
+    """
+    Welch PSD of every series, like scipy.signal.welch with a Hann window, 50 % overlap and mean detrending.
+
+    Series shorter than nperseg get NaN.
+
+    Returns:
+        tuple: frequencies (S, nperseg//2+1) and psd (S, nperseg//2+1)
+    """
+    step = nperseg // 2
+    n_freq = nperseg // 2 + 1
+    n_windows = numpy.where(lengths >= nperseg, (lengths - nperseg) // step + 1, 0)
+    owner = numpy.repeat(numpy.arange(len(starts)), n_windows)
+    first_window = numpy.cumsum(n_windows) - n_windows
+    window_start = starts[owner] + (numpy.arange(len(owner)) - first_window[owner]) * step
+
+    window = 0.5 - 0.5 * numpy.cos(2 * numpy.pi * numpy.arange(nperseg) / nperseg)
+    psd = numpy.zeros((len(starts), n_freq))
+    batch = max(1, BATCH_VALUES // nperseg)
+    for b in range(0, len(owner), batch):
+        frames = values[window_start[b:b + batch, None] + numpy.arange(nperseg)]
+        frames = frames - frames.mean(axis=1, keepdims=True)
+        spectrum = numpy.abs(numpy.fft.rfft(frames * window, axis=1)) ** 2
+        numpy.add.at(psd, owner[b:b + batch], spectrum)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        psd /= (n_windows * fs * numpy.sum(window ** 2))[:, None]
+    # One-sided spectrum: everything but DC (and Nyquist for even nperseg) counts twice.
+    psd[:, 1:n_freq - (nperseg % 2 == 0)] *= 2
+    frequencies = numpy.arange(n_freq)[None, :] * (fs / nperseg)[:, None]
+    return frequencies, psd
+
+
+def autocorrelation(values, starts, lengths, max_lag=256):
+    """
+    Normalised (biased) autocorrelation of every series for lags 0..max_lag.
+
+    Lags beyond the length of a series are NaN.
+    """
+    max_lag = int(min(max_lag, lengths.max() - 1)) if len(lengths) else 0
+    longest = int(lengths.max()) if len(lengths) else 1
+    n_fft = 1 << int(numpy.ceil(numpy.log2(2 * longest)))
+    result = numpy.full((len(starts), max_lag + 1), numpy.nan)
+    batch = max(1, BATCH_VALUES // n_fft)
+    for b in range(0, len(starts), batch):
+        s, n = starts[b:b + batch], lengths[b:b + batch]
+        # Zero-padded matrix of the mean-free series of this batch.
+        row = numpy.repeat(numpy.arange(len(s)), n)
+        column = numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n)
+        series = values[numpy.repeat(s, n) + column]
+        means = numpy.bincount(row, weights=series, minlength=len(s)) / n
+        padded = numpy.zeros((len(s), n_fft))
+        padded[row, column] = series - means[row]
+        spectrum = numpy.fft.rfft(padded, axis=1)
+        covariance = numpy.fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2, n=n_fft, axis=1)[:, :max_lag + 1]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            rho = covariance / covariance[:, :1]
+        rho[numpy.arange(max_lag + 1)[None, :] >= n[:, None]] = numpy.nan
+        result[b:b + batch] = rho
+    return result
+
+
+def integral_time(rho, fs):
+    """Integral time scale [s]: trapezoid integral of rho up to its first non-positive value."""
+    if rho.shape[1] == 0:
+        return numpy.full(len(rho), numpy.nan)
+    crossed = numpy.cumsum(~(rho > 0), axis=1)
+    # Lags before the first zero, plus the first non-positive lag itself.
+    included = (crossed == 0) | ((crossed == 1) & ~(rho > 0))
+    values = numpy.where(included & ~numpy.isnan(rho), rho, 0.)
+    last = numpy.maximum(included.sum(axis=1) - 1, 0)
+    integral = values.sum(axis=1) - 0.5 * values[:, 0] - 0.5 * values[numpy.arange(len(rho)), last]
+    return integral / fs
+
+
+def reverse_arrangement(values, starts, lengths, blocks=STATIONARITY_BLOCKS):
+    """
+    z score of the reverse arrangement test on the block means of every series.
+
+    Series with fewer samples than blocks get NaN.
+    """
+    z = numpy.full(len(starts), numpy.nan)
+    valid = numpy.flatnonzero(lengths >= blocks)
+    if len(valid) == 0:
+        return z
+    s, n = starts[valid], lengths[valid]
+    bounds = s[:, None] + (n[:, None] * numpy.arange(blocks + 1)[None, :]) // blocks
+    cumulative = numpy.concatenate(([0.], numpy.cumsum(values)))
+    means = (cumulative[bounds[:, 1:]] - cumulative[bounds[:, :-1]]) / numpy.diff(bounds, axis=1)
+    later = numpy.triu(numpy.ones((blocks, blocks), dtype=bool), 1)
+    arrangements = ((means[:, :, None] > means[:, None, :]) & later).sum(axis=(1, 2))
+    mean = blocks * (blocks - 1) / 4.
+    std = numpy.sqrt(blocks * (2 * blocks + 5) * (blocks - 1) / 72.)
+    z[valid] = (arrangements - mean) / std
+    return z
+
+
+@profiling.stage('spectral_analysis')
+def analyse(columns, nperseg=64, max_lag=256, max_gap=MAX_GAP, fs=None):
+    """
+    Spectral analysis of every measured point of a columnar dataset.
+
+    Args:
+        columns (dict): Dataset as returned by data_store.load_dataset()
+        nperseg (int): Welch segment length in samples
+        max_lag (int): Longest autocorrelation lag in samples
+        max_gap (float): Seconds between samples that start a new point measurement
+        fs (float): Sample rate of the anemometer [Hz], estimated per point by sample_rates() if None
+
+    Returns:
+        dict: Per point METRICS arrays plus frequencies, psd and autocorrelation
+    """
+    order, starts, lengths = point_series(columns, max_gap)
+    velocity = numpy.asarray(columns['velocity'], dtype=float)[order]
+    time = columns['time'].astype('datetime64[s]')[order]
+    if fs is None:
+        fs = sample_rates(time.astype(numpy.int64), starts, lengths)
+    else:
+        fs = numpy.full(len(starts), float(fs))
+
+    sums = numpy.add.reduceat(velocity, starts) if len(starts) else numpy.zeros(0)
+    avg_speed = sums / lengths if len(starts) else sums
+    deviation = velocity - numpy.repeat(avg_speed, lengths)
+    std_speed = numpy.sqrt(numpy.add.reduceat(deviation ** 2, starts) / lengths) if len(starts) else sums
+
+    frequencies, psd = welch(velocity, starts, lengths, fs, nperseg)
+    rho = autocorrelation(velocity, starts, lengths, max_lag)
+    integral_time_s = integral_time(rho, fs)
+    z = reverse_arrangement(velocity, starts, lengths)
+
+    first = order[starts]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        result = {'x': columns['x'][first], 'y': columns['y'][first], 'z': columns['z'][first],
+                  'probe': columns['probe'][first],
+                  'percent': columns['percent'][first], 'percent_str': columns['percent_str'][first],
+                  'start': time[starts], 'samples': lengths, 'sample_rate_hz': fs,
+                  'avg_speed': avg_speed, 'std_dev_speed': std_speed,
+                  'turbulence': 100.0 * std_speed / avg_speed,
+                  'integral_time_s': integral_time_s,
+                  'integral_length_m': integral_time_s * avg_speed,
+                  'reverse_arrangement': z,
+                  'stationary': numpy.abs(z) < 1.96}
+    result.update({'frequencies': frequencies, 'psd': psd, 'autocorrelation': rho})
+    return result
+
+
+def write_results(result, csv_path=DEFAULT_CSV_PATH, npz_path=DEFAULT_NPZ_PATH):
+    """Write the per point metrics as CSV and everything (with the spectra) as .npz."""
+    folder = os.path.dirname(csv_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(csv_path, 'w') as f:
+        f.write(','.join(METRICS) + '\n')
+        for row in zip(*(result[name].tolist() for name in METRICS)):
+            f.write(','.join(str(v) for v in row) + '\n')
+    numpy.savez(npz_path, **{name: numpy.asarray(values) for name, values in result.items()})
+
+
+def run(columns_path=data_store.DEFAULT_COLUMNS_PATH, nperseg=64, max_lag=256, fs=None):
+    """Analyse the exported dataset and write the results, returns the analysis."""
+    result = analyse(data_store.load_dataset(columns_path), nperseg=nperseg, max_lag=max_lag, fs=fs)
+    write_results(result)
+    return result
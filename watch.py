@@ -0,0 +1,341 @@
+"""
+Incremental processing of measurement runs while they are being recorded.
+
+Watcher polls the meritve/meritve_* folders. For every AHB*.XLS log it keeps the
+byte offset of the first line it has not read yet, and for every casi_ run the
+running statistics of each point. On every poll it:
+
+    1. re-parses the casi_ files that grew,
+    2. reads only the new, complete lines of the logs,
+    3. assigns the new samples to the point windows (vectorised, like
+       prirejene_meritve) and merges them into the statistics of every
+       point and probe (offset by sonde.json, like correlate_columns),
+    4. redraws the figures of the runs that received samples and
+    5. appends the new samples to results/all_data.csv and results/all_data/.
+
+Samples after the start of a point that is still being measured (its end is
+only known when the traverse moves on) are held back until the point is
+closed, so nothing is assigned too early. A run without a final point_end
+(e.g. interrupted with Ctrl+C) counts as finished once a later run in the
+same folder has started or its casi_ file has not changed for
+STALE_RUN_SECONDS; its last, unclosed point is dropped.
+
+    python watch.py            # or: traverse watch
+"""
+
+import argparse
+import collections
+import glob
+import os
+import shutil
+import time
+
+import numpy
+
+import data_store
+import procesiranje
+import xls_index
+
+# A casi_ file without point_end that has not changed for this long belongs to an aborted run [s].
+STALE_RUN_SECONDS = 600.
+
+
+class Watcher:
+    """
+    Polls the measurement folders and processes only what is new.
+
+    Args:
+        meritve (str): Folder with the meritve_* folders
+        make_pictures (bool): Redraw the figures of runs that received samples
+        write_csv (bool): Also append to results/all_data.csv
+        csv_path, columns_path (str): Export locations
+    """
+
+    def __init__(self, meritve='meritve', make_pictures=True, write_csv=True,
+                 csv_path=data_store.DEFAULT_CSV_PATH, columns_path=data_store.DEFAULT_COLUMNS_PATH):
+        self.meritve = meritve
+        self.make_pictures = make_pictures
+        self.write_csv = write_csv
+        self.csv_path = csv_path
+        self.columns_path = columns_path
+        # casi_ path -> {'size', 'folder', 'points', 'percent', 'percent_str'}
+        self.runs = {}
+        # AHB*.XLS path -> offset of the first line that was not read yet
+        self.offsets = {}
+        # AHB*.XLS path -> batches of samples that were read but are after the horizon
+        self.pending = {}
+        # (casi_ path, (x,y,z), probe) -> numpy array [n, mean_speed, M2_speed, mean_temp, M2_temp]
+        self.stats = {}
+        self.started = False
+
+    def _start_export(self):
+        # The export is rebuilt from the first poll on, so it never holds samples twice.
+        folder = os.path.dirname(self.csv_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        if self.write_csv:
+            procesiranje.write_file_csv([procesiranje.GLAVA_CSV], self.csv_path)
+        data_store.write_columns([], self.columns_path)
+        self.started = True
+
+    def _update_runs(self, folder):
+        for path in glob.glob(os.path.join(folder, "casi_*")):
+            size = os.path.getsize(path)
+            run = self.runs.get(path)
+            if size == 0 or (run is not None and run['size'] == size):
+                continue
+            with open(path, 'rb') as f:
+                f.seek(max(size - 256, 0))
+                end = f.read()
+            if not end.endswith(b'\n'):
+                # The traverse is writing this line right now, try again on the next poll.
+                continue
+            try:
+                points = procesiranje.seznam_tock(path, izpis=False)
+            except (ValueError, KeyError) as e:
+                print("Skipping %s for now: %s" % (path, e))
+                continue
+            head, tail = os.path.split(path)
+            percent = tail.split('_')[-1]
+            # traverse_plane writes point_end only after the last point of the run.
+            finished = end.rstrip().split(b'\n')[-1].startswith(b'point_end')
+            self.runs[path] = {'size': size, 'folder': folder, 'points': points, 'finished': finished,
+                               'percent': percent.split('p')[0], 'percent_str': percent}
+
+    def _windows(self, folder):
+        """Closed point windows of a folder, sorted by start, and the time up to which samples can be assigned."""
+        starts, ends, owners = [], [], []
+        # Last event of the runs that have no point_end yet.
+        unfinished = {}
+        first_events = []
+        for path, run in self.runs.items():
+            if run['folder'] != folder or not run['points']:
+                continue
+            first_event = last_event = None
+            for xyz, point in run['points'].items():
+                start = xls_index.datetime_seconds(point['srt_point'])
+                first_event = start if first_event is None else min(first_event, start)
+                last_event = start if last_event is None else max(last_event, start)
+                if 'end_point' not in point:
+                    continue
+                end = xls_index.datetime_seconds(point['end_point'])
+                last_event = max(last_event, end)
+                starts.append(start)
+                ends.append(end)
+                owners.append((path, xyz))
+            first_events.append(first_event)
+            if not run['finished']:
+                unfinished[path] = last_event
+
+        # Last event of every run that is still being recorded; the points after it are not known yet.
+        # Only one run is measured at a time, so a run is over once a later one has started.
+        running = []
+        now = time.time()
+        for path, last_event in unfinished.items():
+            if any(other > last_event for other in first_events):
+                continue
+            try:
+                if now - os.path.getmtime(path) > STALE_RUN_SECONDS:
+                    continue
+            except OSError:
+                continue
+            running.append(last_event)
+        if running:
+            horizon = min(running)
+        else:
+            horizon = max(ends) if ends else None
+
+        order = numpy.argsort(starts, kind='stable')
+        return (numpy.asarray(starts, dtype=numpy.int64)[order],
+                numpy.asarray(ends, dtype=numpy.int64)[order],
+                [owners[i] for i in order],
+                horizon)
+
+    def _read_new(self, path, horizon):
+        """
+        Samples of a log up to horizon (arrays as procesiranje.preberi_meritve) that were not returned yet.
+
+        Only the complete lines written since the previous poll are read and parsed. Samples after
+        the horizon are kept in self.pending until a later poll's horizon reaches them, so the tail
+        of the log after the last run is not read again on every poll.
+        """
+        offset = self.offsets.get(path, 0)
+        size = os.path.getsize(path)
+        if size < offset:
+            print("%s got shorter, reading it again from the start" % path)
+            offset = 0
+            self.pending.pop(path, None)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+
+        # Only complete lines; the logger may be writing the last one.
+        complete = data[:data.rfind(b'\n') + 1]
+        self.offsets[path] = offset + len(complete)
+        lines = [line.rstrip('\r') + '\n' for line in complete.decode(xls_index.ENCODING).split('\n')[:-1]]
+        pending = self.pending.setdefault(path, collections.deque())
+        new = procesiranje.preberi_meritve(lines)
+        if len(new['seconds']):
+            pending.append(new)
+
+        # The log is in time order: everything from the first sample after the horizon waits for a later poll.
+        ready = []
+        while pending and pending[0]['seconds'][0] <= horizon:
+            batch = pending.popleft()
+            later = numpy.flatnonzero(batch['seconds'] > horizon)
+            if len(later):
+                ready.append({name: values[:later[0]] for name, values in batch.items()})
+                pending.appendleft({name: values[later[0]:] for name, values in batch.items()})
+                break
+            ready.append(batch)
+        if not ready:
+            return procesiranje.preberi_meritve([])
+        return {name: numpy.concatenate([batch[name] for batch in ready]) for name in ready[0]}
+
+    def _merge(self, owners, index, speeds, temps):
+        """Merge a batch of samples into the running per-point and per-probe statistics (Chan et al.)."""
+        n_owners = len(owners)
+        n_b = numpy.bincount(index, minlength=n_owners).astype(float)
+        touched = numpy.flatnonzero(n_b)
+        for column, values in ((1, speeds), (3, temps)):
+            mean_b = numpy.bincount(index, weights=values, minlength=n_owners)[touched] / n_b[touched]
+            full_mean = numpy.zeros(n_owners)
+            full_mean[touched] = mean_b
+            m2_b = numpy.bincount(index, weights=(values - full_mean[index]) ** 2, minlength=n_owners)[touched]
+            for k, owner in enumerate(touched):
+                key = owners[owner]
+                s = self.stats.setdefault(key, numpy.zeros(5))
+                n_a = s[0]
+                n = n_a + n_b[owner]
+                delta = mean_b[k] - s[column]
+                s[column] += delta * n_b[owner] / n
+                s[column + 1] += m2_b[k] + delta ** 2 * n_a * n_b[owner] / n
+        for owner in touched:
+            self.stats[owners[owner]][0] += n_b[owner]
+        return {owners[o][0] for o in touched}
+
+    def averages(self, run_path):
+        """Statistics of a run in the format returned by procesiranje.calculate_averages()."""
+        output_list = []
+        n_all = 0.
+        sums = numpy.zeros(4)
+        for (path, (x, y, z), probe), s in self.stats.items():
+            if path != run_path or s[0] == 0:
+                continue
+            n, mean_v, m2_v, mean_t, m2_t = s
+            std_v = numpy.sqrt(m2_v / n)
+            output_list.append({"x": x, "y": y, "z": z, "probe": probe,
+                                "avg_speed": mean_v,
+                                "avg_temp": mean_t,
+                                "std_dev_speed": std_v,
+                                "std_dev_temp": numpy.sqrt(m2_t / n),
+                                "turbulence": 100.0 * std_v / mean_v})
+            n_all += n
+            sums += (n * mean_v, m2_v + n * mean_v ** 2, n * mean_t, m2_t + n * mean_t ** 2)
+        global_speed, global_temp = sums[0] / n_all, sums[2] / n_all
+        return {"output_list": output_list,
+                "global_speed": global_speed,
+                "global_temp": global_temp,
+                "global_speed_std": numpy.sqrt(max(sums[1] / n_all - global_speed ** 2, 0.)),
+                "global_temp_std": numpy.sqrt(max(sums[3] / n_all - global_temp ** 2, 0.))}
+
+    def _draw(self, run_path):
+        run = self.runs[run_path]
+        folder = run['folder']
+        for sub in ('slikice', 'slikice_absolute'):
+            os.makedirs(os.path.join(folder, sub), exist_ok=True)
+        try:
+            procesiranje.izrisi_povprecja(self.averages(run_path), run_path, folder)
+        except Exception as e:
+            # Too few points for the interpolation, it works once the run has a few more.
+            print("Could not draw %s yet: %s" % (run_path, e))
+            return
+        for sub, skupaj in (('slikice', 'slikice_skupaj'), ('slikice_absolute', 'slikice_absolute_skupaj')):
+            os.makedirs(os.path.join('results', skupaj), exist_ok=True)
+            for png in glob.glob(os.path.join(folder, sub, '*_%s.png' % run['percent_str'])):
+                shutil.copyfile(png, os.path.join('results', skupaj, os.path.basename(png)))
+
+    def poll(self):
+        """
+        Process everything that arrived since the previous poll.
+
+        Returns:
+            dict: Number of new samples, assigned samples and the updated runs
+        """
+        if not self.started:
+            self._start_export()
+
+        new_samples = 0
+        rows = []
+        updated_runs = set()
+        for folder in sorted(glob.glob(os.path.join(self.meritve, "meritve_*"))):
+            self._update_runs(folder)
+            starts, ends, owners, horizon = self._windows(folder)
+            if horizon is None:
+                continue
+            offsets = procesiranje.odmiki_sond(folder)
+            batches = [self._read_new(path, horizon) for path in sorted(glob.glob(os.path.join(folder, "AHB*.XLS")))]
+            if not batches:
+                continue
+            samples = {name: numpy.concatenate([b[name] for b in batches]) for name in batches[0]}
+            seconds = samples['seconds']
+            new_samples += len(seconds)
+            if not len(seconds) or not owners:
+                continue
+
+            i = numpy.searchsorted(starts, seconds, side='right') - 1
+            inside = (i >= 0) & (seconds > starts[numpy.maximum(i, 0)]) & (seconds < ends[numpy.maximum(i, 0)])
+            assigned = numpy.flatnonzero(inside)
+            if len(assigned) == 0:
+                continue
+            times = xls_index.seconds_to_datetime64(seconds[assigned]).astype(object)
+            # Every probe of the rake is its own point, shifted by its offset from the traverse position.
+            keys = {}
+            index = []
+            for owner, date_obj, speed, unit_speed, temp, unit_temp, probe in zip(
+                    i[assigned].tolist(), times, samples['velocity'][assigned].tolist(),
+                    samples['velocity_unit'][assigned].tolist(), samples['temperature'][assigned].tolist(),
+                    samples['temperature_unit'][assigned].tolist(), samples['probe'][assigned].tolist()):
+                path, xyz = owners[owner]
+                run = self.runs[path]
+                dx, dy, dz = offsets.get(probe, (0., 0., 0.))
+                x, y, z = xyz[0] + dx, xyz[1] + dy, xyz[2] + dz
+                index.append(keys.setdefault((path, (x, y, z), probe), len(keys)))
+                rows.append([x, y, z, date_obj, speed, unit_speed.strip(), temp, unit_temp.strip(),
+                             run['percent'], run['percent_str'], probe])
+            updated_runs |= self._merge(list(keys), numpy.array(index), samples['velocity'][assigned],
+                                        samples['temperature'][assigned])
+
+        if rows:
+            if self.write_csv:
+                procesiranje.write_file_csv(rows, self.csv_path, mode='a')
+            data_store.append_columns(rows, self.columns_path)
+        if self.make_pictures:
+            for run_path in sorted(updated_runs):
+                self._draw(run_path)
+        return {'new_samples': new_samples, 'assigned_samples': len(rows), 'updated_runs': sorted(updated_runs)}
+
+    def run(self, interval=2.):
+        """Poll until interrupted."""
+        print("Watching %s, press Ctrl+C to stop." % self.meritve)
+        try:
+            while True:
+                start = time.time()
+                summary = self.poll()
+                if summary['assigned_samples']:
+                    print("%s new samples, updated: %s (%.2f s)" % (
+                        summary['assigned_samples'], ', '.join(os.path.basename(r) for r in summary['updated_runs']),
+                        time.time() - start))
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process new measurement runs as they are recorded.")
+    parser.add_argument('--meritve', default='meritve')
+    parser.add_argument('--interval', type=float, default=2.)
+    parser.add_argument('--no-pictures', action='store_true')
+    parser.add_argument('--no-csv', action='store_true')
+    args = parser.parse_args()
+    Watcher(args.meritve, make_pictures=not args.no_pictures, write_csv=not args.no_csv).run(args.interval)
@@ -0,0 +1,270 @@
+"""
+Precomputed wind field lookup table over (y, z, tunnel percentage, temperature).
+
+The fitted WindModel only predicts the velocity at the measured traverse
+locations. The lookup table interpolates the model coefficients once over a
+(y, z) grid through the measured positions and tabulates the velocity for a
+grid of operating points, so arbitrary positions are answered with a
+multilinear interpolation:
+
+    field = wind_field.get_wind_field()
+    v = field.query(y, z, percentage, temperature)   # arrays of any length
+
+y and z are traverse coordinates in mm, like the x,y,z keys of the measurements.
+The table is stored as a plain .npy file and loaded memory mapped.
+"""
+
+import glob
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import wind_interpolation
+
+FIELD_FOLDER = os.path.join('results', 'wind_fields')
+TABLE_FILE = 'table.npy'
+AXES_FILE = 'axes.npz'
+META_FILE = 'meta.json'
+
+DEFAULT_PERCENTAGE = np.linspace(0, 100, 21)
+DEFAULT_TEMPERATURE = np.linspace(0, 40, 9)
+
+_field_cache = {}
+
+
+def multilinear_interpolate(axes, table, points):
+    """
+    Multilinear interpolation on a regular, possibly non-uniform grid.
+
+    Queries outside the grid are clamped to its boundary.
+
+    Args:
+        axes (list): D increasing 1-D arrays, the grid coordinates of each table axis
+        table (array): D-dimensional table, table.shape[d] == len(axes[d])
+        points (array): (n, D) query points
+
+    Returns:
+        array: (n,) interpolated values
+    """
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    lower = []
+    upper = []
+    weights = []
+    for d, axis in enumerate(axes):
+        axis = np.asarray(axis, dtype=float)
+        x = points[:, d]
+        if len(axis) == 1:
+            i = np.zeros(len(x), dtype=int)
+            lower.append(i)
+            upper.append(i)
+            weights.append(np.zeros(len(x)))
+            continue
+        i = np.clip(np.searchsorted(axis, x, side='right') - 1, 0, len(axis) - 2)
+        t = np.clip((x - axis[i]) / (axis[i + 1] - axis[i]), 0., 1.)
+        lower.append(i)
+        upper.append(i + 1)
+        weights.append(t)
+
+    # One gather per corner of the hypercube, each over all query points.
+    result = np.zeros(len(points))
+    for corner in itertools.product((0, 1), repeat=len(axes)):
+        index = tuple(upper[d] if c else lower[d] for d, c in enumerate(corner))
+        w = np.ones(len(points))
+        for d, c in enumerate(corner):
+            w *= weights[d] if c else 1. - weights[d]
+        result += w * table[index]
+    return result
+
+
+def _interpolate_coefficients(locations, coefficients, y, z):
+    """Coefficients (ny, nz, k) on the (y, z) grid, linear inside the measured area, nearest outside."""
+    import scipy.interpolate
+    import scipy.spatial
+
+    yz = locations[:, 1:3]
+    Y, Z = np.meshgrid(y, z, indexing='ij')
+    grid = np.column_stack((Y.reshape(-1), Z.reshape(-1)))
+
+    nearest = scipy.interpolate.NearestNDInterpolator(yz, coefficients)(grid)
+    try:
+        linear = scipy.interpolate.LinearNDInterpolator(yz, coefficients)(grid)
+    except scipy.spatial.QhullError:
+        # Locations on a single line, there is no area to interpolate over.
+        linear = nearest
+    values = np.where(np.isnan(linear), nearest, linear)
+    return values.reshape(len(y), len(z), -1)
+
+
+class WindField:
+    """
+    Velocity lookup table over (y, z, percentage, temperature).
+
+    Attributes:
+        y, z (array): Traverse coordinates of the spatial grid [mm]
+        percentage (array): Wind tunnel percentages of the table
+        temperature (array): Temperatures of the table [degC]
+        table (array): (ny, nz, npercentage, ntemperature) velocities [m/s]
+    """
+
+    def __init__(self, y, z, percentage, temperature, table, source_hash='', order=1):
+        self.y = np.asarray(y, dtype=float)
+        self.z = np.asarray(z, dtype=float)
+        self.percentage = np.asarray(percentage, dtype=float)
+        self.temperature = np.asarray(temperature, dtype=float)
+        self.table = table
+        self.source_hash = source_hash
+        self.order = order
+
+    @property
+    def axes(self):
+        return [self.y, self.z, self.percentage, self.temperature]
+
+    def query(self, y, z, percentage, temperature):
+        """Velocity at arbitrary positions and operating points, all arguments broadcast together."""
+        y, z, percentage, temperature = np.broadcast_arrays(y, z, percentage, temperature)
+        points = np.column_stack([a.reshape(-1) for a in (y, z, percentage, temperature)])
+        return multilinear_interpolate(self.axes, self.table, points).reshape(y.shape)
+
+    def save(self, folder, replace=True):
+        """
+        Write the table as .npy plus its axes into folder.
+
+        The field is written to a temporary folder next to it and renamed into
+        place, so a table that is memory mapped (by this or another process) is
+        never overwritten and a half written field is never loaded. An existing
+        field is moved aside first if replace is set, otherwise it is kept.
+        """
+        parent = os.path.dirname(os.path.abspath(folder))
+        os.makedirs(parent, exist_ok=True)
+        tmp_folder = tempfile.mkdtemp(prefix=os.path.basename(folder)+'.', suffix='.tmp', dir=parent)
+        try:
+            np.save(os.path.join(tmp_folder, TABLE_FILE), np.asarray(self.table, dtype=np.float32))
+            np.savez(os.path.join(tmp_folder, AXES_FILE), y=self.y, z=self.z,
+                     percentage=self.percentage, temperature=self.temperature)
+            with open(os.path.join(tmp_folder, META_FILE), 'w') as f:
+                json.dump({'source_hash': self.source_hash, 'order': self.order,
+                           'model_version': wind_interpolation.MODEL_VERSION}, f)
+            if replace and os.path.exists(folder):
+                _remove_field_folder(folder)
+            try:
+                os.replace(tmp_folder, folder)
+            except OSError:
+                # Another writer stored the same field first.
+                if not os.path.exists(os.path.join(folder, META_FILE)):
+                    raise
+        finally:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        """Read a field written by save(), the table is memory mapped by default."""
+        with open(os.path.join(folder, META_FILE), 'r') as f:
+            meta = json.load(f)
+        with np.load(os.path.join(folder, AXES_FILE)) as axes:
+            y, z = axes['y'], axes['z']
+            percentage, temperature = axes['percentage'], axes['temperature']
+        table = np.load(os.path.join(folder, TABLE_FILE), mmap_mode=mmap_mode)
+        return cls(y, z, percentage, temperature, table,
+                   source_hash=meta['source_hash'], order=meta['order'])
+
+
+def _remove_field_folder(folder):
+    """Move a stored field aside and delete it; files still mapped elsewhere (Windows) are left behind."""
+    parent = os.path.dirname(os.path.abspath(folder))
+    trash = tempfile.mkdtemp(prefix=os.path.basename(folder)+'.', suffix='.old', dir=parent)
+    try:
+        os.replace(folder, os.path.join(trash, 'field'))
+    except OSError:
+        pass
+    shutil.rmtree(trash, ignore_errors=True)
+
+
+def _grid_axis(measured, n):
+    """n evenly spaced values over the measured positions, merged with the positions themselves."""
+    return np.union1d(np.linspace(measured.min(), measured.max(), n), measured)
+
+
+def build_wind_field(model, n_y=50, n_z=50, percentage=DEFAULT_PERCENTAGE, temperature=DEFAULT_TEMPERATURE):
+    """
+    Tabulate a WindModel on a (y, z) grid spanning its locations.
+
+    The grid lines of n_y x n_z evenly spaced values are merged with the
+    measured y and z positions, so the table is exact at the traverse
+    locations. The velocity is linear in the model coefficients, so the
+    coefficients are interpolated over space once and the table is a single
+    matrix product with the design matrix of all (percentage, temperature) pairs.
+    """
+    locations = model.locations
+    y = _grid_axis(locations[:, 1], n_y)
+    z = _grid_axis(locations[:, 2], n_z)
+    percentage = np.asarray(percentage, dtype=float)
+    temperature = np.asarray(temperature, dtype=float)
+
+    coefficients = _interpolate_coefficients(locations, model.coefficients, y, z)
+    P, T = np.meshgrid(percentage, temperature, indexing='ij')
+    A = wind_interpolation.design_matrix(P, T, model.order)
+    table = (coefficients @ A.T).reshape(len(y), len(z), len(percentage), len(temperature))
+    return WindField(y, z, percentage, temperature, table.astype(np.float32),
+                     source_hash=model.source_hash, order=model.order)
+
+
+def field_folder(model, n_y, n_z, percentage, temperature, folder=FIELD_FOLDER):
+    """Field folder name, keyed by the model artefact and the table resolution."""
+    key = hashlib.sha1()
+    key.update(os.path.basename(wind_interpolation.model_path(model.source_hash, model.order)).encode('ascii'))
+    key.update(np.asarray([n_y, n_z], dtype=np.int64).tobytes())
+    key.update(np.asarray(percentage, dtype=float).tobytes())
+    key.update(np.asarray(temperature, dtype=float).tobytes())
+    return os.path.join(folder, 'wind_field_%s' % key.hexdigest()[:16])
+
+
+def prune_fields(source_hash, folder=FIELD_FOLDER):
+    """Delete the stored fields of models that were not fitted on the dataset with source_hash."""
+    for path in glob.glob(os.path.join(folder, 'wind_field_*')):
+        if path.endswith('.old'):
+            # Left behind by _remove_field_folder while another process still had it mapped.
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        if not os.path.isdir(path) or path.endswith('.tmp'):
+            continue
+        try:
+            with open(os.path.join(path, META_FILE), 'r') as f:
+                meta = json.load(f)
+            current = meta['source_hash'] == source_hash and \
+                meta.get('model_version') == wind_interpolation.MODEL_VERSION
+        except (OSError, ValueError, KeyError):
+            current = False
+        if not current:
+            _remove_field_folder(path)
+
+
+def get_wind_field(order=1, n_y=50, n_z=50, percentage=DEFAULT_PERCENTAGE, temperature=DEFAULT_TEMPERATURE, rebuild=False):
+    """
+    WindField of the current model, built once and stored under results/wind_fields/.
+
+    Args:
+        order (int): Polynomial order of the underlying WindModel
+        n_y, n_z (int): Spatial grid resolution
+        percentage, temperature (array): Operating point axes of the table
+        rebuild (bool): Rebuild the model and the table, ignoring all caches
+    """
+    model = wind_interpolation.get_model(order, rebuild=rebuild)
+    folder = field_folder(model, n_y, n_z, percentage, temperature)
+    if not rebuild and folder in _field_cache:
+        return _field_cache[folder]
+
+    field = None
+    if not rebuild and os.path.exists(os.path.join(folder, META_FILE)):
+        field = WindField.load(folder)
+    if field is None:
+        build_wind_field(model, n_y, n_z, percentage, temperature).save(folder, replace=rebuild)
+        field = WindField.load(folder)
+        prune_fields(model.source_hash, os.path.dirname(folder))
+    _field_cache.clear()
+    _field_cache[folder] = field
+    return field
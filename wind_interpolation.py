@@ -1,16 +1,18 @@
 import numpy
 import os
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
+import glob
+import hashlib
+import tempfile
 import numpy as np
-import scipy.linalg
-import scipy.interpolate
-import matplotlib.cm as cm
-from mpldatacursor import datacursor
-from sympy.solvers import solve
-from sympy import Symbol, Eq
+import data_store
+import profiling
+
+# matplotlib and scipy are imported inside the functions that draw or use them,
+# so importing this module for predictions stays cheap.
 
 def create_approximation_plane(x,y,z,_print=False,order=1):
+    import scipy.linalg
+
     data = np.c_[x,y,z]
     mn = np.min(data, axis=0)
     mx = np.max(data, axis=0)
@@ -50,6 +52,10 @@ def create_approximation_plane(x,y,z,_print=False,order=1):
 
 
 def draw_colormap(x,y,z,absolute_scale=False,absolute_min=0,absolute_max=30):
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
+    import scipy.interpolate
+
     # Ne vem ali je to potrebno. Menda je.
     x = numpy.array(x)
     y = numpy.array(y)
@@ -81,94 +87,163 @@ def draw_colormap(x,y,z,absolute_scale=False,absolute_min=0,absolute_max=30):
     #if prikazi:
     plt.show()
 
-def get_approximation_planes(order=1):
-    f = open(os.path.join('results','all_data.csv'),'r')
-
-    data = {}
-
-    for line in f.readlines()[1:]:
-        x,y,z,date,vel,vel_u,temp,temp_u,perc,perc_str = line.strip()[:-1].split(',')
-        x = float(x)
-        y = float(y)
-        z = float(z)
-        if not (x,y,z) in data:
-            data[(x,y,z)] = []
-        data[(x,y,z)].append([vel,temp,perc])
-
-    all_points =  {}
-
-    for loc,dat in data.items():
-        all_vel = []
-        all_temp = []
-        all_perc = []
-        for d in dat:
-            all_vel.append(float(d[0]))
-            all_temp.append(float(d[1]))
-            all_perc.append(float(d[2]))
-        all_points[loc] = {"all_vel":all_vel,"all_temp":all_temp,"all_perc":all_perc}
+def _monomial_exponents(order):
+    """
+    Exponents (i, j) of the model terms percentage**i * temperature**j.
 
-    approximation_functions = {}
+    Orders 1 and 2 keep the coefficient layout of create_approximation_plane(),
+    higher orders append the remaining terms of each degree.
+    """
+    if order == 1:
+        return [(1,0), (0,1), (0,0)]
+    exponents = [(0,0), (1,0), (0,1), (1,1), (2,0), (0,2)]
+    for degree in range(3, order+1):
+        exponents += [(degree-j, j) for j in range(degree+1)]
+    return exponents
 
-    #fig = plt.figure()
-    #ax = fig.add_subplot(111, projection='3d')
-    #ax.set_xlabel('Procent vetrovnika [%]')
-    #ax.set_ylabel('Temperatura [C]')
-    #ax.set_zlabel('Hitrost vetra [m/s]')
 
-    for k in all_points:
-        
-        x = all_points[k]['all_perc']
-        y = all_points[k]['all_temp']
-        z = all_points[k]['all_vel']
+def design_matrix(percentage, temperature, order=1):
+    """
+    Design matrix (N, k) of the (percentage, temperature) -> velocity model.
+    """
+    p = np.asarray(percentage, dtype=float).reshape(-1)
+    t = np.asarray(temperature, dtype=float).reshape(-1)
+    return np.column_stack([p**i * t**j for i,j in _monomial_exponents(order)])
 
-        #print(k,':')
-        X,Y,Z,func,C = create_approximation_plane(x,y,z,order=order,_print=False)
-        
-        approximation_functions[k] = func
-        #surf = ax.plot_surface(X, Y, Z, rstride=1, cstride=1, alpha=0.2,label=str(k))
 
-        """
-        fig = plt.figure()
-        ax = fig.add_subplot(111, projection='3d')
-        ax.scatter(x,y,z)
-        ax.plot_surface(X, Y, Z, rstride=1, cstride=1, alpha=0.2)
-        plt.title("x:"+str(-k[1])+" y:"+str(-k[2]))
-        plt.xlabel('Procent vetrovnika [%]')
-        plt.ylabel('Temperatura [C]')
-        plt.show()
-        """
-    #datacursor()
-    #plt.show()
+# Upper bound of the number of float64 values in one batch of padded design matrices.
+FIT_BATCH_VALUES = 1 << 22
+
+
+def fit_location_models(index, percentage, temperature, velocity, order=1, n_locations=None, rcond=1e-12):
+    """
+    Least-squares fit of one model per location, for all locations at once.
+
+    The samples are grouped by location into a stack of zero-padded design
+    matrices (zero rows do not change a least-squares solution), which is
+    solved with one batched SVD per block of locations, so there is no Python
+    loop over locations. Like scipy.linalg.lstsq, the singular values of the
+    design matrix itself are compared with rcond, the normal equations are
+    never formed. Columns are scaled to unit maximum before solving.
+
+    Args:
+        index (array): Location index of every sample, in range(n_locations)
+        percentage, temperature, velocity (array): Samples
+        order (int): Polynomial order of the model
+        n_locations (int): Number of locations (default: index.max()+1)
+        rcond (float): Relative cutoff for small singular values
+
+    Returns:
+        tuple: (C, residuals, cond)
+            C (L, k): coefficients in the layout of _monomial_exponents(order)
+            residuals (L,): sum of squared residuals per location
+            cond (L,): condition number of the (scaled) design matrix per location
+    """
+    index = np.asarray(index).reshape(-1)
+    if n_locations is None:
+        n_locations = int(index.max())+1
+    b = np.asarray(velocity, dtype=float).reshape(-1)
+    A = design_matrix(percentage, temperature, order)
+    k = A.shape[1]
+
+    scale = np.abs(A).max(axis=0) if len(A) else np.ones(k)
+    scale[scale == 0] = 1.
+    As = A/scale
+
+    # Samples sorted by location; row[i] is the padded row of the i-th sorted sample.
+    by_location = np.argsort(index, kind='stable')
+    counts = np.bincount(index, minlength=n_locations)
+    first = np.cumsum(counts)-counts
+    row = np.arange(len(index))-np.repeat(first, counts)
+    longest = max(int(counts.max()) if n_locations else 0, 1)
+
+    C = np.zeros((n_locations, k))
+    cond = np.full(n_locations, np.nan)
+    batch = max(1, FIT_BATCH_VALUES//(longest*(k+1)))
+    for lo in range(0, n_locations, batch):
+        hi = min(lo+batch, n_locations)
+        sorted_block = slice(first[lo], first[hi-1]+counts[hi-1])
+        samples = by_location[sorted_block]
+        location = index[samples]-lo
+        padded = np.zeros((hi-lo, longest, k))
+        padded[location, row[sorted_block]] = As[samples]
+        rhs = np.zeros((hi-lo, longest))
+        rhs[location, row[sorted_block]] = b[samples]
+
+        u, sv, vt = np.linalg.svd(padded, full_matrices=False)
+        cutoff = rcond*sv[:,:1]
+        sv_inv = np.where(sv > cutoff, 1./np.where(sv > cutoff, sv, 1.), 0.)
+        C[lo:hi] = np.einsum('lji,lj,lnj,ln->li', vt, sv_inv, u, rhs)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cond[lo:hi] = sv[:,0]/sv[:,-1]
+    C /= scale
+
+    fitted = np.einsum('ij,ij->i', A, C[index])
+    residuals = np.bincount(index, weights=(fitted-b)**2, minlength=n_locations)
+    return C, residuals, cond
+
+
+@profiling.stage('fit_approximation_planes')
+def fit_approximation_planes(order=1):
+    """
+    Fit the velocity model of every traverse location in results/all_data.
+
+    Returns:
+        tuple: (locations, C, residuals, cond), locations is an (L, 3) array of x,y,z
+            and the rest is as returned by fit_location_models().
+    """
+    columns = data_store.load_dataset()
+    locations, index = data_store.group_locations(columns)
+    C, residuals, cond = fit_location_models(index, columns['percent'], columns['temperature'],
+                                             columns['velocity'], order=order, n_locations=len(locations))
+    return locations, C, residuals, cond
+
+
+def _plane_function(C, order):
+    def plane_function(X,Y,_print=False):
+        return np.dot(design_matrix(X, Y, order), C).reshape(np.shape(X))
+    return plane_function
+
+
+@profiling.stage('get_approximation_planes')
+def get_approximation_planes(order=1):
+    locations, C, residuals, cond = fit_approximation_planes(order)
+    approximation_functions = {}
+    for loc, c in zip(locations, C):
+        approximation_functions[tuple(loc.tolist())] = _plane_function(c, order)
     return approximation_functions
 
 
-def _generate_wind(percentage_wind_tunnel,temperature,approximation_functions):
+def evaluate_wind(C, percentage, temperature, order=1):
+    """
+    Evaluate all location models for a batch of operating points.
+
+    Args:
+        C (array): (L, k) coefficients from fit_location_models()
+        percentage, temperature (array): n operating points (scalars are allowed)
+        order (int): Polynomial order the coefficients were fitted with
 
-    all_x = []
-    all_y = []
-    all_z = []
+    Returns:
+        tuple: (Z, plane_mean), Z is the (n, L) velocity at every location
+            and plane_mean the (n,) average over the plane.
+    """
+    A = design_matrix(percentage, temperature, order)
+    Z = A @ np.asarray(C).T
+    # The plane average of a linear model is the model with averaged coefficients.
+    plane_mean = A @ np.mean(C, axis=0)
+    return Z, plane_mean
 
-    for k,ff in approximation_functions.items():
-        x,y,z = -k[1], -k[2], ff(percentage_wind_tunnel,temperature)
-        all_x.append(x)
-        all_y.append(y)
-        all_z.append(z)
 
-    return all_x,all_y,all_z
+def _generate_wind(percentage_wind_tunnel,temperature,locations,C,order=1):
+    Z, plane_mean = evaluate_wind(C, percentage_wind_tunnel, temperature, order)
+    return -locations[:,1], -locations[:,2], Z[0]
 
 def get_average_plane():
-    approximation_functions = get_approximation_planes()
-    all_i = []
-    all_j = []
-    all_k = []
-    for i in np.linspace(0,100,10):
-        for j in np.linspace(0,40,10):
-            X,Y,Z = _generate_wind(percentage_wind_tunnel=i,temperature=j,approximation_functions=approximation_functions)
-            #draw_colormap(X,Y,Z)
-            k = np.mean(Z)
-            all_i.append(i)
-            all_j.append(j)
-            all_k.append(k)
+    C = get_model(1).coefficients
+    all_i, all_j = np.meshgrid(np.linspace(0,100,10), np.linspace(0,40,10), indexing='ij')
+    all_i = all_i.reshape(-1)
+    all_j = all_j.reshape(-1)
+    Z, all_k = evaluate_wind(C, all_i, all_j, order=1)
     """
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
@@ -183,29 +258,268 @@ def get_average_plane():
 
 
 def generate_wind(percentage_wind_tunnel,temperature):
-    approximation_functions = get_approximation_planes(1)
-    X,Y,Z = _generate_wind(percentage_wind_tunnel,temperature,approximation_functions=approximation_functions)
+    model = get_model(1)
+    X,Y,Z = _generate_wind(percentage_wind_tunnel,temperature,model.locations,model.coefficients)
     return X,Y,Z,np.mean(Z)
 
-def get_percentage(temperature,desired_speed):
-    #draw_colormap(X1,Y1,Z1)
-    X2,Y2,Z2,avg_func,C = get_average_plane()
-    a,b,c = C
-    p = Symbol('p')
-    T = Symbol('T')
-    v = Symbol('v')
-    eq = Eq(a*p+b*T+c,v)
-    s = solve(eq,p)
-    needed_percentage = s[0].subs({T:temperature, v:desired_speed})
-    print("To reach %s m/s @ %s degC, the wind tunnel percentage has to be %s %%." % (desired_speed,temperature,needed_percentage))
-
-X1,Y1,Z1,avg = generate_wind(percentage_wind_tunnel=40,temperature=25)
-draw_colormap(X1,Y1,Z1)
-#get_percentage(temperature=25,desired_speed=10)
-#X,Y,Z,func,C = get_average_plane()
-#fig = plt.figure()
-#ax = fig.add_subplot(111, projection='3d')
-#ax.scatter(x,y,z)
-#ax.plot_surface(X, Y, Z, rstride=1, cstride=1, alpha=0.2)
-#plt.show()
+def _polynomial_in_percentage(C, temperature, order=1):
+    """
+    Coefficients (n, order+1) of velocity as a polynomial in percentage,
+    with the temperature of each query substituted. Column i multiplies percentage**i.
+    """
+    t = np.asarray(temperature, dtype=float).reshape(-1)
+    poly = np.zeros((t.size, order+1))
+    for c, (i,j) in zip(C, _monomial_exponents(order)):
+        poly[:,i] += c*t**j
+    return poly
+
+
+def solve_percentage(C, desired_speed, temperature, order=1, bounds=(0,100)):
+    """
+    Wind tunnel percentage at which a model reaches the desired speed.
+
+    Order 1 is solved analytically, order 2 with the quadratic formula and higher
+    orders with the eigenvalues of a stack of companion matrices. For every order
+    the real root closest to bounds is returned (the smallest one if several lie
+    inside). bounds only choose between roots: a speed outside the measured range
+    gives the extrapolated percentage outside bounds, not nan.
+
+    Args:
+        C (array): (k,) coefficients of a single model
+        desired_speed, temperature (array): n queries (scalars are allowed)
+        order (int): Polynomial order the coefficients were fitted with
+        bounds (tuple): Valid percentage range used to pick between roots
+
+    Returns:
+        array: (n,) percentages, nan where the model has no real root (e.g. a
+            constant model, or a quadratic that never reaches the speed)
+    """
+    v = np.asarray(desired_speed, dtype=float).reshape(-1)
+    poly = _polynomial_in_percentage(C, temperature, order)
+    v, poly = np.broadcast_arrays(v[:,None], poly)
+    poly = poly.copy()
+    poly[:,0] -= v[:,0]
+
+    if order == 1:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            roots = (-poly[:,0]/poly[:,1])[:,None]
+    elif order == 2:
+        c0, c1, c2 = poly[:,0], poly[:,1], poly[:,2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sqrt_disc = np.sqrt(c1**2 - 4*c2*c0)
+            # Numerically stable form, avoids cancellation between -c1 and sqrt_disc.
+            q = -0.5*(c1 + np.copysign(sqrt_disc, c1))
+            roots = np.column_stack((q/c2, c0/q))
+            linear = np.abs(c2) <= 1e-12*np.abs(c1)
+            roots[linear] = (-c0/c1)[linear,None]
+    else:
+        # Companion matrices of the monic polynomials, solved as one stack.
+        n = poly.shape[0]
+        companion = np.zeros((n, order, order))
+        companion[:,1:,:-1] = np.eye(order-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            companion[:,:,-1] = -poly[:,:-1]/poly[:,-1:]
+        finite = np.isfinite(companion).all(axis=(1,2))
+        eig = np.full((n, order), np.nan, dtype=complex)
+        eig[finite] = np.linalg.eigvals(companion[finite])
+        real = np.abs(eig.imag) <= 1e-9*np.maximum(1., np.abs(eig.real))
+        roots = np.where(real, eig.real, np.nan)
+
+    lo, hi = bounds
+    distance = np.maximum(lo - roots, 0.) + np.maximum(roots - hi, 0.)
+    distance = np.where(np.isnan(roots), np.inf, distance)
+    candidates = np.where(distance == distance.min(axis=1, keepdims=True), roots, np.inf)
+    result = candidates.min(axis=1)
+    result[~np.isfinite(result)] = np.nan
+    return result
+
+
+# Bump when the fitting code changes, so old model artefacts are not reused.
+MODEL_VERSION = 2
+MODEL_FOLDER = os.path.join('results','wind_models')
+
+_model_cache = {}
+
+
+class WindModel:
+    """
+    Fitted (percentage, temperature) -> velocity models of all traverse locations.
+
+    Attributes:
+        locations (array): (L, 3) x,y,z traverse locations
+        coefficients (array): (L, k) model coefficients, see _monomial_exponents()
+        residuals (array): (L,) sum of squared residuals
+        cond (array): (L,) condition numbers of the fits
+        order (int): Polynomial order of the models
+        source_hash (str): SHA-1 of the dataset the models were fitted on
+    """
+
+    def __init__(self, locations, coefficients, residuals, cond, order=1, source_hash=''):
+        self.locations = np.asarray(locations, dtype=float)
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.residuals = np.asarray(residuals, dtype=float)
+        self.cond = np.asarray(cond, dtype=float)
+        self.order = int(order)
+        self.source_hash = source_hash
+
+    @classmethod
+    def fit(cls, order=1, source_hash=''):
+        """Fit the models on results/all_data."""
+        locations, C, residuals, cond = fit_approximation_planes(order)
+        return cls(locations, C, residuals, cond, order=order, source_hash=source_hash)
+
+    def evaluate(self, percentage, temperature):
+        """(n, L) velocities and (n,) plane means, see evaluate_wind()."""
+        return evaluate_wind(self.coefficients, percentage, temperature, self.order)
+
+    def location_index(self, location):
+        """Row of the x,y,z location in self.locations."""
+        matches = np.flatnonzero((self.locations == np.asarray(location, dtype=float)).all(axis=1))
+        if len(matches) == 0:
+            raise ValueError("No model for location %s" % (location,))
+        return matches[0]
+
+    def solve_percentage(self, desired_speed, temperature, location=None):
+        """Percentages reaching desired_speed for the plane average or one x,y,z location."""
+        if location is None:
+            c = np.mean(self.coefficients, axis=0)
+        else:
+            c = self.coefficients[self.location_index(location)]
+        return solve_percentage(c, desired_speed, temperature, order=self.order)
+
+    def save(self, path):
+        """
+        Write the model to an .npz file, atomically replacing an existing one.
+
+        Every writer uses its own temporary file, so concurrent saves of the
+        same model (threads of the server, the CLI) do not interfere.
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path)+'.', suffix='.tmp', dir=folder or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f,
+                         locations=self.locations,
+                         coefficients=self.coefficients,
+                         residuals=self.residuals,
+                         cond=self.cond,
+                         order=self.order,
+                         model_version=MODEL_VERSION,
+                         source_hash=self.source_hash)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a model written by save().
+
+        Raises:
+            ValueError: If the file was written by a different MODEL_VERSION
+        """
+        with np.load(path, allow_pickle=False) as f:
+            if int(f['model_version']) != MODEL_VERSION:
+                raise ValueError("Wind model %s has version %s, expected %s" % (path, int(f['model_version']), MODEL_VERSION))
+            return cls(f['locations'], f['coefficients'], f['residuals'], f['cond'],
+                       order=int(f['order']), source_hash=str(f['source_hash']))
 
+
+def model_path(source_hash, order=1, folder=MODEL_FOLDER):
+    """Artefact file name, keyed by the dataset hash, model order and MODEL_VERSION."""
+    key = hashlib.sha1(("%s:%s:%s" % (source_hash, order, MODEL_VERSION)).encode('ascii')).hexdigest()
+    return os.path.join(folder, 'wind_model_%s.npz' % key[:16])
+
+
+def prune_models(source_hash, folder=MODEL_FOLDER):
+    """
+    Delete the stored models that were not fitted on the dataset with source_hash.
+
+    Watch mode changes the dataset on every poll, without pruning every change
+    would leave another artefact behind. Files another process still has open
+    (Windows) are left for the next call.
+    """
+    for path in glob.glob(os.path.join(folder, 'wind_model_*.npz')):
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                current = str(f['source_hash']) == source_hash and int(f['model_version']) == MODEL_VERSION
+        except (OSError, ValueError, KeyError):
+            # Saves are atomic, so this is a broken file, not one being written.
+            current = False
+        if not current:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_model(order=1, rebuild=False):
+    """
+    Fitted WindModel for the current results/all_data, loaded once per process.
+
+    The model is cached in memory until the dataset files change and persisted
+    under results/wind_models/, so other processes only fit it once as well.
+    Storing a new model deletes those of older datasets.
+
+    Args:
+        order (int): Polynomial order of the models
+        rebuild (bool): Refit and overwrite the stored model, ignoring all caches
+    """
+    global _model_cache
+    signature = data_store.dataset_signature()
+    cache_key = (signature, order)
+    if not rebuild and cache_key in _model_cache:
+        return _model_cache[cache_key]
+
+    source_hash = data_store.dataset_hash()
+    path = model_path(source_hash, order)
+    model = None
+    if not rebuild and os.path.exists(path):
+        try:
+            model = WindModel.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            print("Refitting wind model, stored model not usable: %s" % e)
+    if model is None:
+        model = WindModel.fit(order, source_hash=source_hash)
+        model.save(path)
+        prune_models(source_hash)
+
+    # Models of an older dataset are never needed again.
+    _model_cache = {k:v for k,v in _model_cache.items() if k[0] == signature}
+    _model_cache[cache_key] = model
+    return model
+
+
+def rebuild_model(order=1):
+    """Refit the model from results/all_data and overwrite the stored artefact."""
+    return get_model(order, rebuild=True)
+
+
+def get_percentage(temperature,desired_speed,order=1,location=None):
+    """
+    Wind tunnel percentage needed to reach desired_speed at the given temperature.
+
+    By default the plane average is targeted, pass an x,y,z location tuple to target
+    a single traverse location. Accepts scalars or arrays; the result is printed for
+    scalar queries.
+    """
+    needed_percentage = get_model(order).solve_percentage(desired_speed, temperature, location)
+    if np.ndim(temperature) == 0 and np.ndim(desired_speed) == 0:
+        needed_percentage = needed_percentage[0]
+        print("To reach %s m/s @ %s degC, the wind tunnel percentage has to be %s %%." % (desired_speed,temperature,needed_percentage))
+    return needed_percentage
+
+if __name__ == "__main__":
+    X1,Y1,Z1,avg = generate_wind(percentage_wind_tunnel=40,temperature=25)
+    draw_colormap(X1,Y1,Z1)
+    #get_percentage(temperature=25,desired_speed=10)
+    #X,Y,Z,func,C = get_average_plane()
+    #fig = plt.figure()
+    #ax = fig.add_subplot(111, projection='3d')
+    #ax.scatter(x,y,z)
+    #ax.plot_surface(X, Y, Z, rstride=1, cstride=1, alpha=0.2)
+    #plt.show()
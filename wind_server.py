@@ -0,0 +1,220 @@
+"""
+Long-lived local server answering wind model queries.
+
+The server fits (or loads) the WindModel once and keeps it in memory. Every
+request checks the dataset files' size and mtime, so a new results/all_data
+written by procesiranje is picked up automatically on the next query.
+
+Start it from the folder that contains results/:
+
+    python wind_server.py --port 8765
+
+Endpoints (JSON in, JSON out, all array arguments broadcast together):
+
+    POST /generate_wind   {"percentage": [...], "temperature": [...]}
+        -> {"y": [...], "z": [...], "velocity": [[...]], "plane_mean": [...]}
+    POST /get_percentage  {"desired_speed": [...], "temperature": [...], "location": [x,y,z] (optional)}
+        -> {"percentage": [...]}
+    POST /field           {"y": [...], "z": [...], "percentage": [...], "temperature": [...]}
+        -> {"velocity": [...]}
+    GET  /health          -> {"source_hash": ..., "order": ..., "locations": ...}
+
+Use WindClient to query it from Python over a persistent connection.
+"""
+
+import argparse
+import http.client
+import http.server
+import json
+import logging
+import socket
+import threading
+
+import numpy as np
+
+import wind_field
+import wind_interpolation
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+logger = logging.getLogger(__name__)
+
+# Requests are answered in parallel threads, but the model and field caches are
+# not thread safe: only one thread at a time checks, loads or rebuilds them.
+_load_lock = threading.Lock()
+
+
+def _model(order):
+    with _load_lock:
+        return wind_interpolation.get_model(order)
+
+
+def _field(order):
+    with _load_lock:
+        return wind_field.get_wind_field(order)
+
+
+def _array(request, name):
+    if name not in request:
+        raise ValueError("Missing argument: %s" % name)
+    return np.asarray(request[name], dtype=float)
+
+
+def handle_generate_wind(request, order=1):
+    model = _model(order)
+    percentage, temperature = np.broadcast_arrays(_array(request, 'percentage'), _array(request, 'temperature'))
+    velocity, plane_mean = model.evaluate(percentage.reshape(-1), temperature.reshape(-1))
+    return {'y': (-model.locations[:, 1]).tolist(),
+            'z': (-model.locations[:, 2]).tolist(),
+            'velocity': velocity.tolist(),
+            'plane_mean': plane_mean.tolist()}
+
+
+def handle_get_percentage(request, order=1):
+    model = _model(order)
+    percentage = model.solve_percentage(_array(request, 'desired_speed'), _array(request, 'temperature'),
+                                        request.get('location'))
+    # nan is not valid JSON.
+    return {'percentage': [None if np.isnan(p) else p for p in percentage.tolist()]}
+
+
+def handle_field(request, order=1):
+    field = _field(order)
+    velocity = field.query(_array(request, 'y'), _array(request, 'z'),
+                           _array(request, 'percentage'), _array(request, 'temperature'))
+    return {'velocity': np.atleast_1d(velocity).tolist()}
+
+
+def handle_health(request, order=1):
+    model = _model(order)
+    return {'source_hash': model.source_hash, 'order': model.order, 'locations': len(model.locations)}
+
+
+HANDLERS = {
+    '/generate_wind': handle_generate_wind,
+    '/get_percentage': handle_get_percentage,
+    '/field': handle_field,
+    '/health': handle_health,
+}
+
+
+class WindRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    order = 1
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, request):
+        handler = HANDLERS.get(self.path)
+        if handler is None:
+            self._reply(404, {'error': 'Unknown endpoint: %s' % self.path})
+            return
+        try:
+            self._reply(200, handler(request, self.order))
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+        except Exception as e:
+            logger.exception("Query %s failed", self.path)
+            self._reply(500, {'error': str(e)})
+
+    def do_GET(self):
+        self._dispatch({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self._reply(400, {'error': 'Invalid JSON: %s' % e})
+            return
+        self._dispatch(request)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, order=1, preload_field=False):
+    """Load the model once and answer queries until interrupted."""
+    model = _model(order)
+    if preload_field:
+        _field(order)
+    logger.info("Serving wind model %s (%s locations) on http://%s:%s",
+                model.source_hash[:8], len(model.locations), host, port)
+
+    handler = type('WindRequestHandler', (WindRequestHandler,), {'order': order})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class WindClient:
+    """
+    Client for the wind model server, keeps one connection open between queries.
+
+    Args:
+        host (str): Server address
+        port (int): Server port
+        timeout (float): Socket timeout in seconds
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=10):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, body=None):
+        if self.connection.sock is None:
+            self.connection.connect()
+            self.connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        self.connection.request(method, path, body=data, headers={'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError("Wind server error %s: %s" % (response.status, result.get('error')))
+        return result
+
+    def generate_wind(self, percentage, temperature):
+        return self._request('POST', '/generate_wind',
+                             {'percentage': np.asarray(percentage).tolist(),
+                              'temperature': np.asarray(temperature).tolist()})
+
+    def get_percentage(self, desired_speed, temperature, location=None):
+        body = {'desired_speed': np.asarray(desired_speed).tolist(),
+                'temperature': np.asarray(temperature).tolist()}
+        if location is not None:
+            body['location'] = list(location)
+        return self._request('POST', '/get_percentage', body)['percentage']
+
+    def field(self, y, z, percentage, temperature):
+        return self._request('POST', '/field',
+                             {'y': np.asarray(y).tolist(), 'z': np.asarray(z).tolist(),
+                              'percentage': np.asarray(percentage).tolist(),
+                              'temperature': np.asarray(temperature).tolist()})['velocity']
+
+    def health(self):
+        return self._request('GET', '/health')
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve wind model queries over localhost HTTP.")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--order', type=int, default=1)
+    parser.add_argument('--preload-field', action='store_true', help="Build the spatial lookup table at startup")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    serve(args.host, args.port, args.order, args.preload_field)
@@ -0,0 +1,270 @@
+"""
+Sparse time index for the anemometer AHB*.XLS logs.
+
+The logger writes one tab separated line per sample, in time order, and a log
+file often covers a whole day. A casi_ run only needs the few minutes between
+its first point_start and its last point_end, so instead of reading the whole
+file, a sidecar index (AHB01000.XLS.idx.npz) maps the timestamp of every
+INDEX_STEP-th sample line to its byte offset. read_windows() then memory maps
+the log and decodes only the byte ranges that overlap the requested windows.
+
+The index is built once and reused while the log's size and mtime are
+unchanged. When the log only grew (the logger appended samples), the index is
+extended from where it stopped instead of being rebuilt.
+"""
+
+import hashlib
+import mmap
+import os
+import time
+from datetime import date
+
+import numpy
+
+INDEX_VERSION = 1
+INDEX_STEP = 256
+INDEX_SUFFIX = '.idx.npz'
+# Bytes at the start of the log that identify it when checking whether it only grew.
+HEAD_BYTES = 1024
+# A log not modified for this long is finished, its last line counts even without a newline [s].
+QUIET_SECONDS = 10.
+
+ENCODING = 'latin-1'
+# parse_xls_seconds() of 1970-01-01, the numpy datetime64 epoch.
+EPOCH_SECONDS = date(1970, 1, 1).toordinal() * 86400
+
+
+def parse_xls_seconds(date_field, time_field):
+    """
+    Seconds since 0001-01-01 of an XLS date and time field (bytes or str).
+
+    The logger writes dates as Y/m/d or m/d/Y, whichever it likes.
+
+    Raises:
+        ValueError: If the fields are not a date and a time (e.g. the header line)
+    """
+    if isinstance(date_field, bytes):
+        date_field = date_field.decode(ENCODING)
+        time_field = time_field.decode(ENCODING)
+    a, b, c = date_field.split('/')
+    if len(a) == 4:
+        day = date(int(a), int(b), int(c))
+    else:
+        day = date(int(c), int(a), int(b))
+    hours, minutes, seconds = time_field.split(':')
+    return day.toordinal() * 86400 + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def parse_xls_seconds_array(date_fields, time_fields):
+    """
+    parse_xls_seconds() of whole arrays of date and time fields.
+
+    Every distinct date is parsed once; H:M:S times are converted with array arithmetic.
+
+    Returns:
+        array: int64 seconds
+    """
+    dates, date_index = numpy.unique(numpy.asarray(date_fields, dtype=str), return_inverse=True)
+    day_seconds = numpy.array([parse_xls_seconds(d, '0:0:0') for d in dates], dtype=numpy.int64)
+    times = numpy.asarray(time_fields, dtype=str)
+    if len(times) and times.dtype.itemsize == 8 * 4 and numpy.all(numpy.char.str_len(times) == 8):
+        # Fixed width HH:MM:SS, the digits as an (n, 8) array of code points.
+        digits = times.view(numpy.uint32).reshape(-1, 8).astype(numpy.int64) - ord('0')
+        seconds = (digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60 \
+            + digits[:, 6] * 10 + digits[:, 7]
+    else:
+        seconds = numpy.array([parse_xls_seconds('1/1/1', t) - 86400 for t in times], dtype=numpy.int64)
+    return day_seconds[date_index.reshape(-1)] + seconds
+
+
+def seconds_to_datetime64(seconds):
+    """parse_xls_seconds() seconds as numpy datetime64[s]."""
+    return (numpy.asarray(seconds, dtype=numpy.int64) - EPOCH_SECONDS).astype('datetime64[s]')
+
+
+def datetime_seconds(datetime_obj):
+    """datetime in the same seconds scale as parse_xls_seconds()."""
+    return datetime_obj.toordinal() * 86400 + datetime_obj.hour * 3600 + datetime_obj.minute * 60 + datetime_obj.second
+
+
+def _line_seconds(line):
+    fields = line.split(b'\t', 3)
+    if len(fields) < 4:
+        return None
+    try:
+        return parse_xls_seconds(fields[1], fields[2])
+    except ValueError:
+        return None
+
+
+class XlsIndex:
+    """
+    Timestamp -> byte offset table of one log file.
+
+    Attributes:
+        times (array): Seconds (see parse_xls_seconds) of every INDEX_STEP-th sample line
+        offsets (array): Byte offset of the start of those lines
+        indexed_to (int): Offset after the last complete line that was indexed
+        monotonic (bool): False if the sample times ever go backwards
+    """
+
+    def __init__(self, times, offsets, indexed_to, monotonic, count, last_time, size, mtime_ns, head):
+        self.times = numpy.asarray(times, dtype=numpy.int64)
+        self.offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        self.indexed_to = int(indexed_to)
+        self.monotonic = bool(monotonic)
+        self.count = int(count)
+        self.last_time = int(last_time)
+        self.size = int(size)
+        self.mtime_ns = int(mtime_ns)
+        self.head = head
+
+    def ranges(self, windows):
+        """
+        Merged byte ranges (start, end) that contain all lines inside the windows.
+
+        Args:
+            windows (list): (start, end) datetimes
+        """
+        if not self.monotonic or len(self.times) == 0:
+            return [(0, self.indexed_to)] if self.indexed_to else []
+
+        windows = numpy.array([(datetime_seconds(s), datetime_seconds(e)) for s, e in windows],
+                              dtype=numpy.int64).reshape(-1, 2)
+        # Last entry at or before the start; every earlier line is not after the start.
+        first = numpy.searchsorted(self.times, windows[:, 0], side='right') - 1
+        # First entry after the end; every later line is after the end as well.
+        last = numpy.searchsorted(self.times, windows[:, 1], side='right')
+        starts = self.offsets[numpy.maximum(first, 0)]
+        ends = numpy.append(self.offsets, self.indexed_to)[last]
+
+        merged = []
+        for start, end in sorted(zip(starts.tolist(), ends.tolist())):
+            if end <= start:
+                continue
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [tuple(r) for r in merged]
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                numpy.savez(f, version=INDEX_VERSION, times=self.times, offsets=self.offsets,
+                            indexed_to=self.indexed_to, monotonic=self.monotonic, count=self.count,
+                            last_time=self.last_time, size=self.size, mtime_ns=self.mtime_ns, head=self.head)
+            os.replace(tmp_path, path)
+        except OSError:
+            # A read-only measurement folder only costs a rebuild next time.
+            pass
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path, allow_pickle=False) as f:
+            if int(f['version']) != INDEX_VERSION:
+                raise ValueError("Unsupported XLS index version")
+            return cls(f['times'], f['offsets'], f['indexed_to'], f['monotonic'], f['count'],
+                       f['last_time'], f['size'], f['mtime_ns'], str(f['head']))
+
+
+def _head_hash(data):
+    return hashlib.sha1(data[:HEAD_BYTES]).hexdigest()
+
+
+def _scan(data, start, index_lists, count, last_time, monotonic):
+    """Index the complete lines of data from offset start, returns the updated state."""
+    times, offsets = index_lists
+    pos = start
+    end_of_data = len(data)
+    while pos < end_of_data:
+        end = data.find(b'\n', pos)
+        if end == -1:
+            # The logger is still writing this line.
+            break
+        t = _line_seconds(data[pos:end])
+        if t is not None:
+            if count and t < last_time:
+                monotonic = False
+            if count % INDEX_STEP == 0:
+                times.append(t)
+                offsets.append(pos)
+            last_time = t
+            count += 1
+        pos = end + 1
+    return pos, count, last_time, monotonic
+
+
+def build_index(path, previous=None):
+    """
+    Index a log file, extending previous if the file only grew since it was indexed.
+    """
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b''
+        try:
+            head = _head_hash(data)
+            # Grown in place: the start of the file is what the previous index saw.
+            if previous is not None and st.st_size >= previous.size and previous.indexed_to <= st.st_size \
+                    and _head_hash(data[:min(previous.size, HEAD_BYTES)]) == previous.head:
+                lists = (previous.times.tolist(), previous.offsets.tolist())
+                state = (previous.indexed_to, previous.count, previous.last_time, previous.monotonic)
+            else:
+                lists = ([], [])
+                state = (0, 0, 0, True)
+            indexed_to, count, last_time, monotonic = _scan(data, state[0], lists, *state[1:])
+        finally:
+            if st.st_size:
+                data.close()
+    return XlsIndex(lists[0], lists[1], indexed_to, monotonic, count, last_time,
+                    st.st_size, st.st_mtime_ns, head)
+
+
+def get_index(path):
+    """Index of a log file, from its sidecar if it is still valid, otherwise (re)built and saved."""
+    index_path = path + INDEX_SUFFIX
+    st = os.stat(path)
+    previous = None
+    if os.path.exists(index_path):
+        try:
+            previous = XlsIndex.load(index_path)
+        except (OSError, ValueError, KeyError):
+            previous = None
+    if previous is not None and previous.size == st.st_size and previous.mtime_ns == st.st_mtime_ns:
+        return previous
+    index = build_index(path, previous)
+    index.save(index_path)
+    return index
+
+
+def read_range(path, start, end):
+    """Decoded lines of the byte range [start, end) of a log file."""
+    if end <= start:
+        return []
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunk = data[start:end]
+    # Same lines as reading the file in text mode: newline kept, \r\n normalised.
+    return [line.rstrip('\r\n') + '\n' for line in chunk.decode(ENCODING).splitlines()]
+
+
+def read_windows(path, windows):
+    """
+    Lines of a log file that can fall inside any of the (start, end) datetime windows.
+
+    The result may contain a few lines around the windows (up to INDEX_STEP on
+    each side), the caller still has to check the sample times. A last line
+    without a newline is only read once the log has been quiet for QUIET_SECONDS.
+    """
+    index = get_index(path)
+    ranges = index.ranges(windows)
+    if ranges and ranges[-1][1] == index.indexed_to and index.indexed_to < index.size \
+            and time.time() - index.mtime_ns / 1e9 > QUIET_SECONDS:
+        # The last line of a finished log may lack its newline, the index stops before it.
+        # If it is incomplete after all, the caller drops it like any other malformed line.
+        ranges[-1] = (ranges[-1][0], index.size)
+    lines = []
+    for start, end in ranges:
+        lines += read_range(path, start, end)
+    return lines